@@ -0,0 +1,70 @@
+"""add lookup indexes
+
+Revision ID: d8c96cfcc7a1
+Revises: 64dc4f62bc00
+Create Date: 2026-10-18 09:12:41.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "d8c96cfcc7a1"
+down_revision: Union[str, None] = "64dc4f62bc00"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction, this lets
+    # the migration be applied to a live database without locking writes
+    with op.get_context().autocommit_block():
+        # also serves the lookups filtering on sku alone
+        op.create_index(
+            "ix_batch_sku_eta",
+            "batch",
+            ["sku", "eta"],
+            unique=False,
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.create_index(
+            "ix_allocations_batch_id",
+            "allocations",
+            ["batch_id"],
+            unique=False,
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.create_index(
+            "ix_allocations_orderline_id",
+            "allocations",
+            ["orderline_id"],
+            unique=False,
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_allocations_orderline_id",
+            table_name="allocations",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+        op.drop_index(
+            "ix_allocations_batch_id",
+            table_name="allocations",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+        op.drop_index(
+            "ix_batch_sku_eta",
+            table_name="batch",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
@@ -0,0 +1,66 @@
+"""add read model views
+
+Revision ID: e5d0db36b666
+Revises: d8c96cfcc7a1
+Create Date: 2026-10-18 11:02:17.540931
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e5d0db36b666"
+down_revision: Union[str, None] = "d8c96cfcc7a1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "allocations_view",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("orderid", sa.String(length=255), nullable=False),
+        sa.Column("sku", sa.String(length=255), nullable=False),
+        sa.Column("qty", sa.Integer(), nullable=False),
+        sa.Column("batchref", sa.String(length=255), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("orderid"),
+    )
+    op.create_table(
+        "availability_view",
+        sa.Column("sku", sa.String(length=255), autoincrement=False, nullable=False),
+        sa.Column("available_quantity", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("sku"),
+    )
+    # backfill the read model from the existing allocations
+    op.execute(
+        """
+        INSERT INTO allocations_view (orderid, sku, qty, batchref)
+        SELECT order_lines.orderid, order_lines.sku, order_lines.qty, allocations.batch_id
+        FROM allocations
+        JOIN order_lines ON order_lines.orderid = allocations.orderline_id
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO availability_view (sku, available_quantity)
+        SELECT batch.sku, SUM(batch._purchased_quantity) - COALESCE(SUM(allocated.qty), 0)
+        FROM batch
+        LEFT JOIN (
+            SELECT allocations.batch_id, SUM(order_lines.qty) AS qty
+            FROM allocations
+            JOIN order_lines ON order_lines.orderid = allocations.orderline_id
+            GROUP BY allocations.batch_id
+        ) AS allocated ON allocated.batch_id = batch.reference
+        WHERE batch.sku IS NOT NULL
+        GROUP BY batch.sku
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("availability_view")
+    op.drop_table("allocations_view")
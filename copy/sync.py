@@ -1,75 +1,580 @@
 import hashlib
+import json
 import os
 import argparse
+import errno
 import shutil
-
+import tempfile
+
+from collections import Counter, defaultdict
+from concurrent.futures import (
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 from pathlib import Path
-from typing import Dict, Tuple, Generator
+from typing import Callable, Dict, Iterable, List, Set, Tuple, Generator
 
-BLOCKSIZE = 65536
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-def hash_file(file_path: str) -> str:
-    hasher = hashlib.sha1()
+BLOCKSIZE = 65536
+# bigger reads when hashing whole files, fewer system calls
+READ_SIZE = 1 << 20
+# hashing is mostly waiting on reads (hashlib releases the GIL on large
+# buffers), so use more threads than cores
+DEFAULT_JOBS = min(32, (os.cpu_count() or 1) + 4)
+# kept in the destination root, and never synced itself
+MANIFEST_NAME = ".sync-manifest.json"
+# files moved out of the way while syncing, in the destination root
+TEMPORARY_PREFIX = ".sync-tmp-"
+# key of the relative paths of the directories in the hash maps
+DIRECTORIES = "directories"
+# any hashlib algorithm, or an xxhash one (e.g. xxh3_128) when installed
+DEFAULT_HASH = "xxh3_128" if xxhash is not None else "blake2b"
+# _IOW(0x94, 9, int) from linux/fs.h, shares the source's extents (btrfs, XFS)
+FICLONE = 0x40049409
+# the errors of a copy strategy the kernel or file systems do not support
+UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EINVAL,
+    errno.ENOTTY,
+    errno.EBADF,
+}
+
+
+def new_hasher(algorithm: str = DEFAULT_HASH):
+    if algorithm.startswith("xxh"):
+        if xxhash is None:
+            raise ValueError(f"{algorithm} needs the xxhash package")
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def hash_file(file_path: str, algorithm: str = DEFAULT_HASH) -> str:
+    hasher = new_hasher(algorithm)
     with open(file_path, "rb") as f:
-        buf = f.read(BLOCKSIZE)
+        buf = f.read(READ_SIZE)
         while buf:
             hasher.update(buf)
-            buf = f.read(BLOCKSIZE)
+            buf = f.read(READ_SIZE)
+    return hasher.hexdigest()
+
+
+def hash_ends(file_path: str, algorithm: str = DEFAULT_HASH) -> str:
+    """
+    Hashes the first and last blocks of a file only, files whose ends
+    differ cannot have the same content
+    """
+    hasher = new_hasher(algorithm)
+    with open(file_path, "rb") as f:
+        hasher.update(f.read(BLOCKSIZE))
+        end = f.seek(0, os.SEEK_END)
+        f.seek(max(0, end - BLOCKSIZE))
+        hasher.update(f.read(BLOCKSIZE))
     return hasher.hexdigest()
 
 
-def read_paths_and_hashes(root) -> Dict[str, str]:
-    hashes: Dict[str, str] = {}
-    for folder, _, files in os.walk(root):
-        for fn in files:
-            rel_path = Path(folder) / fn
-            hashes[hash_file(rel_path)] = fn
-    print(hashes)
+class HashManifest:
+    """
+    Digests of the files of previous syncs keyed by their absolute path,
+    trusted for as long as the size, mtime and inode of the file are the same
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: str | None = None, algorithm: str = DEFAULT_HASH) -> None:
+        self.path = path
+        self.algorithm = algorithm
+        self._entries: Dict[str, List] = self._load() if path else {}
+        # what the next save writes, only the files seen by this sync
+        self._seen: Dict[str, List] = {}
+
+    def _load(self) -> Dict[str, List]:
+        try:
+            with open(self.path, "r") as f:  # type: ignore
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if (manifest.get("version"), manifest.get("hash")) != (
+            self.VERSION,
+            self.algorithm,
+        ):
+            return {}
+        return manifest["files"]
+
+    @staticmethod
+    def _key(stat: os.stat_result) -> List:
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def lookup(self, path: str, stat: os.stat_result) -> str | None:
+        entry = self._entries.get(path)
+        if entry is None or entry[:3] != self._key(stat):
+            return None
+        self._seen[path] = entry
+        return entry[3]
+
+    def record(self, path: str, stat: os.stat_result, digest: str) -> None:
+        if self.path:
+            self._seen[path] = self._key(stat) + [digest]
+
+    def digest(self, path: str) -> str | None:
+        entry = self._seen.get(path)
+        return None if entry is None else entry[3]
+
+    def forget(self, path: str) -> None:
+        self._seen.pop(path, None)
+
+    def save(self) -> None:
+        """
+        Replaces the manifest on disk at once, it is either the previous one
+        or the new one even if the process dies while writing
+        """
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path) or "."
+        fd, tmp_path = tempfile.mkstemp(prefix=MANIFEST_NAME, dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(
+                    dict(version=self.VERSION, hash=self.algorithm, files=self._seen),
+                    f,
+                )
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._entries = dict(self._seen)
+
+
+def _walk(root) -> Tuple[Dict[str, os.stat_result], Set[str]]:
+    """
+    The stat of every file by absolute path, and the directories relative
+    to the root
+    """
+    root = os.path.abspath(root)
+    files, directories = {}, set()
+    for folder, dirnames, fns in os.walk(root):
+        for dirname in dirnames:
+            directories.add(os.path.relpath(os.path.join(folder, dirname), root))
+        for fn in fns:
+            if not fn.startswith(MANIFEST_NAME):
+                path = os.path.join(folder, fn)
+                files[path] = os.stat(path)
+    return files, directories
+
+
+def _hash_map(
+    root, keys: Dict[str, str], files: Iterable[str], directories: Set[str]
+) -> Dict[str, Set[str]]:
+    """
+    Relative paths of the files of a tree by their key, several files can
+    have the same content
+    """
+    root = os.path.abspath(root)
+    hashes: Dict[str, Set[str]] = {DIRECTORIES: directories}
+    for path in files:
+        hashes.setdefault(keys[path], set()).add(os.path.relpath(path, root))
     return hashes
 
 
+def _run(
+    func: Callable[..., str],
+    paths: Iterable[str],
+    executor: Executor | None,
+    *args,
+) -> Dict[str, str]:
+    """
+    func(path, *args) of every path, collected as they complete
+    """
+    if executor is None:
+        return {path: func(path, *args) for path in paths}
+    futures = {executor.submit(func, path, *args): path for path in paths}
+    return {futures[future]: future.result() for future in as_completed(futures)}
+
+
+def _digests(
+    files: Dict[str, os.stat_result],
+    executor: Executor | None,
+    manifest: HashManifest | None,
+    algorithm: str,
+) -> Dict[str, str]:
+    """
+    Full digests of the files, from the manifest when their stat is unchanged
+    """
+    digests, unknown = {}, []
+    for path, stat in files.items():
+        digest = manifest.lookup(path, stat) if manifest is not None else None
+        if digest is None:
+            unknown.append(path)
+        else:
+            digests[path] = digest
+
+    for path, digest in _run(hash_file, unknown, executor, algorithm).items():
+        digests[path] = digest
+        if manifest is not None:
+            manifest.record(path, files[path], digest)
+    return digests
+
+
+def read_paths_and_hashes(
+    root,
+    executor: Executor | None = None,
+    manifest: HashManifest | None = None,
+    algorithm: str = DEFAULT_HASH,
+) -> Dict[str, Set[str]]:
+    files, directories = _walk(root)
+    digests = _digests(files, executor, manifest, algorithm)
+    return _hash_map(root, digests, files, directories)
+
+
+def read_trees(
+    roots: List[str],
+    executor: Executor | None = None,
+    manifest: HashManifest | None = None,
+    algorithm: str = DEFAULT_HASH,
+) -> List[Dict[str, Set[str]]]:
+    """
+    Like read_paths_and_hashes for several trees at once, but files are only
+    read as far as needed to tell whether they can match another file:
+    files of a size no other file has are not read at all, and large files
+    are only hashed in full when their first and last blocks match another's.
+    The files that cannot match anything are keyed by their path instead of
+    a digest
+    """
+    trees = [_walk(root) for root in roots]
+    files = {path: stat for tree, _ in trees for path, stat in tree.items()}
+    keys = {path: f"unique:{path}" for path in files}
+    # files unchanged since the manifest was saved are not read at all
+    known = {}
+    if manifest is not None:
+        for path, stat in files.items():
+            digest = manifest.lookup(path, stat)
+            if digest is not None:
+                known[path] = digest
+    keys.update(known)
+
+    by_size = defaultdict(list)
+    for path, stat in files.items():
+        by_size[stat.st_size].append(path)
+
+    to_digest, partial = [], []
+    for paths in by_size.values():
+        unknown = [path for path in paths if path not in known]
+        if len(paths) < 2 or not unknown:
+            continue
+        if files[paths[0]].st_size <= 2 * BLOCKSIZE or len(unknown) < len(paths):
+            # as cheap to hash small files whole, and ruling out a match with
+            # the known files would mean reading their ends
+            to_digest.extend(unknown)
+        else:
+            partial.append(unknown)
+
+    ends = _run(
+        hash_ends, [path for paths in partial for path in paths], executor, algorithm
+    )
+    for paths in partial:
+        by_ends = defaultdict(list)
+        for path in paths:
+            by_ends[ends[path]].append(path)
+        to_digest.extend(
+            path
+            for same_ends in by_ends.values()
+            if len(same_ends) > 1
+            for path in same_ends
+        )
+
+    keys.update(
+        _digests(
+            {path: files[path] for path in to_digest}, executor, manifest, algorithm
+        )
+    )
+    return [
+        _hash_map(root, keys, tree, directories)
+        for root, (tree, directories) in zip(roots, trees)
+    ]
+
+
+def _parents(path: str) -> List[str]:
+    parents = []
+    parent = os.path.dirname(path)
+    while parent:
+        parents.append(parent)
+        parent = os.path.dirname(parent)
+    return parents
+
+
 def determine_actions(
-    source_hashes: Dict[str, str],
-    destination_hashes: Dict[str, str],
+    source_hashes: Dict[str, Set[str]],
+    destination_hashes: Dict[str, Set[str]],
     source: str,
     destination: str,
-) -> Generator[Tuple[str, str, str | None], None, None]:
-    for sha, fn in source_hashes.items():
-        if sha not in destination_hashes:
-            source_path = Path(source) / fn
-            destination_path = Path(destination) / fn
-            yield ("COPY", str(source_path), str(destination_path))
-        elif destination_hashes[sha] != fn:
-            old_destination_path = Path(destination) / destination_hashes[sha]
-            new_destination_path = Path(destination) / fn
-            yield ("MOVE", str(old_destination_path), str(new_destination_path))
-
-    for sha, fn in destination_hashes.items():
-        if sha not in source_hashes:
-            yield ("DELETE", str(Path(destination) / fn), None)
+) -> Generator[Tuple[str, Path, Path | None], None, None]:
+    """
+    The actions turning the destination tree into the source tree, given
+    the relative paths of their files by digest (and of their directories
+    under DIRECTORIES). Files already in the destination are moved rather
+    than copied, and the actions are ordered so that no file is overwritten
+    or removed before it has been moved where it is needed
+    """
+    source, destination = Path(source), Path(destination)
+
+    moves: List[Tuple[str, str]] = []
+    copies: List[str] = []
+    deletes: List[str] = []
+    for key, paths in source_hashes.items():
+        if key == DIRECTORIES:
+            continue
+        existing = destination_hashes.get(key, set())
+        # the same content can be at several places, in either tree
+        extra = sorted(existing - paths)
+        for path in sorted(paths - existing):
+            if extra:
+                moves.append((extra.pop(0), path))
+            else:
+                copies.append(path)
+        deletes.extend(extra)
+    for key, paths in destination_hashes.items():
+        if key != DIRECTORIES and key not in source_hashes:
+            deletes.extend(sorted(paths))
+
+    written = {new for _, new in moves} | set(copies)
+    needed_dirs = set(source_hashes.get(DIRECTORIES, set()))
+    for key, paths in source_hashes.items():
+        if key != DIRECTORIES:
+            for path in paths:
+                needed_dirs.update(_parents(path))
+    obsolete_dirs = destination_hashes.get(DIRECTORIES, set()) - needed_dirs
+
+    def in_the_way(path: str) -> bool:
+        # where a file is written or a directory created, or inside a
+        # directory that a file replaces
+        return (
+            path in written
+            or path in needed_dirs
+            or any(parent in written for parent in _parents(path))
+        )
+
+    # deepest first
+    def by_depth(dirs):
+        return sorted(dirs, key=lambda d: (-d.count(os.sep), d))
+
+    for path in deletes:
+        yield ("DELETE", destination / path, None)
+
+    staged = []
+    for i, (old, new) in enumerate(moves):
+        if in_the_way(old):
+            temporary = f"{TEMPORARY_PREFIX}{i}"
+            yield ("MOVE", destination / old, destination / temporary)
+            old = temporary
+        staged.append((old, new))
+
+    blocking_dirs = [d for d in by_depth(obsolete_dirs) if in_the_way(d)]
+    for directory in blocking_dirs:
+        yield ("RMDIR", destination / directory, None)
+
+    # parents first
+    existing_dirs = destination_hashes.get(DIRECTORIES, set())
+    for directory in sorted(needed_dirs - existing_dirs):
+        yield ("MKDIR", destination / directory, None)
+
+    for old, new in staged:
+        yield ("MOVE", destination / old, destination / new)
+    for path in copies:
+        yield ("COPY", source / path, destination / path)
+
+    for directory in by_depth(obsolete_dirs):
+        if directory not in blocking_dirs:
+            yield ("RMDIR", destination / directory, None)
+
+
+def _reflink(source_fd: int, destination_fd: int, size: int):
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "reflinks are not supported")
+    fcntl.ioctl(destination_fd, FICLONE, source_fd)
+
+
+def _copy_file_range(source_fd: int, destination_fd: int, size: int):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not supported")
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(
+            source_fd, destination_fd, size - offset, offset, offset
+        )
+        if not copied:
+            break
+        offset += copied
+
+
+def _sendfile(source_fd: int, destination_fd: int, size: int):
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(destination_fd, source_fd, offset, size - offset)
+        if not sent:
+            break
+        offset += sent
+
+
+# fastest first, the data does not go through user space with any of them
+COPY_STRATEGIES: Tuple[Tuple[str, Callable[[int, int, int], None]], ...] = (
+    ("reflink", _reflink),
+    ("copy_file_range", _copy_file_range),
+    ("sendfile", _sendfile),
+)
+
+
+def copy_file(
+    source: str, destination: str, unsupported: Set[str] | None = None
+) -> str:
+    """
+    Copies the content of source to destination with the first strategy
+    that is supported, falling back to shutil, and returns its name.
+    The strategies in unsupported are skipped, and those found unsupported
+    are added to it
+    """
+    if unsupported is None:
+        unsupported = set()
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        size = os.fstat(src.fileno()).st_size
+        for name, strategy in COPY_STRATEGIES:
+            if name in unsupported:
+                continue
+            try:
+                strategy(src.fileno(), dst.fileno(), size)
+                return name
+            except OSError as error:
+                if error.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                unsupported.add(name)
+                # start over, the strategy may have written part of the file
+                os.ftruncate(dst.fileno(), 0)
+                dst.seek(0)
+        src.seek(0)
+        shutil.copyfileobj(src, dst, READ_SIZE)
+        return "shutil"
 
 
 class FileSystem:
-    def __init__(self) -> None:
-        pass
-
-    def read(self, path) -> Dict[str, str]:
-        return read_paths_and_hashes(path)
-
-    def copy(self, source, destination):
-        shutil.copyfile(source, destination)
+    def __init__(
+        self,
+        jobs: int = DEFAULT_JOBS,
+        processes: bool = False,
+        manifest: str | None = None,
+        algorithm: str = DEFAULT_HASH,
+        link: bool = False,
+    ) -> None:
+        """
+        jobs files are hashed at a time, by as many threads, or processes
+        when hashing is CPU bound (e.g. fast disks, few large files).
+        Files whose stat did not change since the digest in the manifest
+        file was computed are not hashed again.
+        With link, files are copied as hard links to the source when both
+        trees are on the same file system, so they share their content
+        """
+        new_hasher(algorithm)  # fail early on unknown algorithms
+        self.jobs = jobs
+        self.processes = processes
+        self.algorithm = algorithm
+        self.manifest = HashManifest(manifest, algorithm)
+        self.link = link
+        # number of files copied with each strategy
+        self.copies: Counter = Counter()
+        # strategies that failed, by source and destination devices
+        self._unsupported: Dict[Tuple[int, int], Set[str]] = defaultdict(set)
+        self._executor: Executor | None = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def executor(self) -> Executor:
+        if self._executor is None:
+            pool = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+            self._executor = pool(max_workers=self.jobs)
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def read(self, path) -> Dict[str, Set[str]]:
+        return read_paths_and_hashes(
+            path, self.executor(), self.manifest, self.algorithm
+        )
+
+    def read_trees(self, *paths) -> List[Dict[str, Set[str]]]:
+        return read_trees(list(paths), self.executor(), self.manifest, self.algorithm)
+
+    def _record(self, path, digest: str | None):
+        # the content of path is known, no need to hash it on the next sync
+        if digest is not None:
+            path = os.path.abspath(path)
+            self.manifest.record(path, os.stat(path), digest)
+
+    def copy(self, source, destination) -> str:
+        """
+        Returns the name of the strategy the file was copied with
+        """
+        devices = os.stat(source).st_dev, os.stat(os.path.dirname(destination)).st_dev
+        unsupported = self._unsupported[devices]
+        strategy = None
+        if self.link and "hardlink" not in unsupported:
+            try:
+                os.link(source, destination)
+                strategy = "hardlink"
+            except OSError as error:
+                if error.errno not in UNSUPPORTED_ERRNOS | {errno.EPERM}:
+                    raise
+                unsupported.add("hardlink")
+        if strategy is None:
+            strategy = copy_file(source, destination, unsupported)
+        self.copies[strategy] += 1
+        self._record(destination, self.manifest.digest(os.path.abspath(source)))
+        return strategy
 
     def move(self, source, destination):
+        digest = self.manifest.digest(os.path.abspath(source))
         shutil.move(source, destination)
+        self.manifest.forget(os.path.abspath(source))
+        self._record(destination, digest)
 
     def remove(self, path):
         os.remove(path)
+        self.manifest.forget(os.path.abspath(path))
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+    def rmdir(self, path):
+        os.rmdir(path)
+
+    def save(self):
+        """
+        Called once the sync succeeded
+        """
+        self.manifest.save()
 
 
 def sync(source_path: str, destination_path: str, filesystem=FileSystem()):
     # Walk the source folder and build  a dict of filenames and their hashes
-    # TODO: make the sync work with nested file structure
     # source_hashes = {}
 
     # for dirpath, dirnames, filenames in os.walk(source_path):
@@ -97,8 +602,9 @@ def sync(source_path: str, destination_path: str, filesystem=FileSystem()):
     # source_hashes = read_paths_and_hashes(source_path)
     # dest_hashes = read_paths_and_hashes(destination_path)
 
-    source_hashes = filesystem.read(source_path)
-    dest_hashes = filesystem.read(destination_path)
+    # both trees are read together, only the files that may match one
+    # another are hashed, and their files share the hashing pool
+    source_hashes, dest_hashes = filesystem.read_trees(source_path, destination_path)
 
     actions = determine_actions(
         source_hashes, dest_hashes, source_path, destination_path
@@ -114,6 +620,12 @@ def sync(source_path: str, destination_path: str, filesystem=FileSystem()):
         elif action == "DELETE":
             # os.remove(paths[0])
             filesystem.remove(paths[0])
+        elif action == "MKDIR":
+            filesystem.mkdir(paths[0])
+        elif action == "RMDIR":
+            filesystem.rmdir(paths[0])
+
+    filesystem.save()
 
 
 def main():
@@ -122,6 +634,34 @@ def main():
     )
     arg_parser.add_argument("source")
     arg_parser.add_argument("destination")
+    arg_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f"number of files hashed in parallel (default {DEFAULT_JOBS})",
+    )
+    arg_parser.add_argument(
+        "--processes",
+        action="store_true",
+        help="hash in worker processes instead of threads",
+    )
+    arg_parser.add_argument(
+        "--hash",
+        default=DEFAULT_HASH,
+        help=f"hash algorithm, from hashlib or xxhash (default {DEFAULT_HASH})",
+    )
+    arg_parser.add_argument(
+        "--link",
+        action="store_true",
+        help="hard link new files to the source instead of copying them, "
+        "when both are on the same file system",
+    )
+    arg_parser.add_argument(
+        "--no-manifest",
+        action="store_true",
+        help=f"hash every file, ignoring and not writing {MANIFEST_NAME}",
+    )
     args = arg_parser.parse_args()
     source_arg: str = args.source
     source_arg = source_arg.replace("./", "")
@@ -130,10 +670,20 @@ def main():
     source_path = f"{os.path.abspath(os.getcwd())}/{source_arg}"
     destination_path = f"{os.path.abspath(os.getcwd())}/{destination_arg}"
 
-    sync(source_path, destination_path)
+    manifest = None if args.no_manifest else f"{destination_path}/{MANIFEST_NAME}"
+    with FileSystem(
+        jobs=args.jobs,
+        processes=args.processes,
+        manifest=manifest,
+        algorithm=args.hash,
+        link=args.link,
+    ) as filesystem:
+        sync(source_path, destination_path, filesystem)
 
     print(source_path)
     print(destination_path)
+    for strategy, count in filesystem.copies.most_common():
+        print(f"{count} file(s) copied with {strategy}")
 
 
 if __name__ == "__main__":
@@ -1,9 +1,20 @@
+import errno
+import os
 import shutil
 import tempfile
 import pytest
 from pathlib import Path
-from sync import sync, determine_actions
-from typing import Dict
+from sync import (
+    BLOCKSIZE,
+    MANIFEST_NAME,
+    FileSystem,
+    copy_file,
+    determine_actions,
+    read_paths_and_hashes,
+    read_trees,
+    sync,
+)
+from typing import Dict, List, Set
 
 
 @pytest.fixture
@@ -62,7 +73,7 @@ def test_when_a_file_has_been_renamed_in_source():
 
 
 def test_file_exists_in_source_simplified():
-    source_hashes = {"hash1": "fn1"}
+    source_hashes = {"hash1": {"fn1"}}
     dest_hashes = {}
     actions = list(
         determine_actions(source_hashes, dest_hashes, Path("/src"), Path("/dest"))
@@ -71,8 +82,8 @@ def test_file_exists_in_source_simplified():
 
 
 def test_file_renamed_simplified():
-    source_hashes = {"hash1": "fn1"}
-    dest_hashes = {"hash1": "fn2"}
+    source_hashes = {"hash1": {"fn1"}}
+    dest_hashes = {"hash1": {"fn2"}}
     actions = list(
         determine_actions(source_hashes, dest_hashes, Path("/src"), Path("/dest"))
     )
@@ -84,9 +95,12 @@ class FakeFileSystem:
         self.path_hashes = path_hashes
         self.actions = []
 
-    def read(self, path) -> Dict[str, str]:
+    def read(self, path) -> Dict[str, Set[str]]:
         return self.path_hashes[path]
 
+    def read_trees(self, *paths) -> List[Dict[str, Set[str]]]:
+        return [self.read(path) for path in paths]
+
     def copy(self, source, destination):
         self.actions.append(("COPY", source, destination))
 
@@ -96,18 +110,229 @@ class FakeFileSystem:
     def remove(self, path):
         self.actions.append(("DELETE", path, None))
 
+    def mkdir(self, path):
+        self.actions.append(("MKDIR", path, None))
+
+    def rmdir(self, path):
+        self.actions.append(("RMDIR", path, None))
+
+    def save(self):
+        pass
+
 
 def test_file_exists_in_source_but_not_in_destination_fakefs():
-    fake_fs = FakeFileSystem({"/src": {"hash1": "fn1"}, "/dst": {}})
+    fake_fs = FakeFileSystem({"/src": {"hash1": {"fn1"}}, "/dst": {}})
 
     sync("/src", "/dst", fake_fs)
 
     assert fake_fs.actions == [("COPY", Path("/src/fn1"), Path("/dst/fn1"))]
 
 
+def test_nested_file_moved_to_new_directory_fakefs():
+    fake_fs = FakeFileSystem(
+        {
+            "/src": {"directories": {"a", "a/b"}, "hash1": {"a/b/fn1"}},
+            "/dst": {"directories": {"old"}, "hash1": {"old/fn1"}},
+        }
+    )
+
+    sync("/src", "/dst", fake_fs)
+
+    assert fake_fs.actions == [
+        ("MKDIR", Path("/dst/a"), None),
+        ("MKDIR", Path("/dst/a/b"), None),
+        ("MOVE", Path("/dst/old/fn1"), Path("/dst/a/b/fn1")),
+        ("RMDIR", Path("/dst/old"), None),
+    ]
+
+
+def test_duplicate_content_fakefs():
+    fake_fs = FakeFileSystem(
+        {
+            "/src": {"hash1": {"fn1", "fn2", "fn3"}, "hash2": {"fn4"}},
+            "/dst": {"hash1": {"fn1", "old"}, "hash2": {"fn4", "copy"}},
+        }
+    )
+
+    sync("/src", "/dst", fake_fs)
+
+    assert fake_fs.actions == [
+        ("DELETE", Path("/dst/copy"), None),
+        ("MOVE", Path("/dst/old"), Path("/dst/fn2")),
+        ("COPY", Path("/src/fn3"), Path("/dst/fn3")),
+    ]
+
+
 def test_file_renamed_fakefs():
-    fake_fs = FakeFileSystem({"/src": {"hash1": "fn1"}, "/dst": {"hash1": "fn2"}})
+    fake_fs = FakeFileSystem({"/src": {"hash1": {"fn1"}}, "/dst": {"hash1": {"fn2"}}})
 
     sync("/src", "/dst", fake_fs)
 
     assert fake_fs.actions == [("MOVE", Path("/dst/fn2"), Path("/dst/fn1"))]
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_parallel_hashing_matches_serial_hashing(create_temp_fs, processes):
+    source, _ = create_temp_fs
+    for i in range(20):
+        (Path(source) / f"file-{i}.txt").write_text(f"content {i}" * i)
+
+    with FileSystem(jobs=4, processes=processes) as filesystem:
+        assert filesystem.read(source) == read_paths_and_hashes(source)
+
+
+def test_unchanged_files_are_not_hashed_again(create_temp_fs, monkeypatch):
+    source, dest = create_temp_fs
+    # of the same size, so that their digests are computed
+    (Path(source) / "unchanged.txt").write_text("unchanged content")
+    (Path(source) / "changed.txt").write_text("changed content 1")
+    manifest = str(Path(dest) / MANIFEST_NAME)
+
+    sync(source, dest, FileSystem(jobs=2, manifest=manifest))
+    (Path(source) / "changed.txt").write_text("changed content 2")
+
+    hashed = []
+    monkeypatch.setattr(
+        "sync.hash_file", lambda path, algorithm: hashed.append(path) or path
+    )
+    FileSystem(jobs=2, manifest=manifest).read(source)
+    FileSystem(jobs=2, manifest=manifest).read(dest)
+
+    assert hashed == [os.path.join(os.path.abspath(source), "changed.txt")]
+    assert sorted(p.name for p in Path(dest).iterdir()) == [
+        MANIFEST_NAME,
+        "changed.txt",
+        "unchanged.txt",
+    ]
+
+
+def test_unchanged_large_files_are_not_read_again(create_temp_fs, monkeypatch):
+    source, dest = create_temp_fs
+    for i in range(5):
+        (Path(source) / f"file-{i}.bin").write_bytes(bytes([i]) * (3 * BLOCKSIZE))
+    manifest = str(Path(dest) / MANIFEST_NAME)
+    # the copies are hashed on the second sync, once they match their source
+    for _ in range(2):
+        sync(source, dest, FileSystem(manifest=manifest))
+
+    read = []
+    monkeypatch.setattr(
+        "sync.hash_ends", lambda path, algorithm: read.append(path) or path
+    )
+    monkeypatch.setattr(
+        "sync.hash_file", lambda path, algorithm: read.append(path) or path
+    )
+    filesystem = FileSystem(manifest=manifest)
+    sync(source, dest, filesystem)
+
+    assert read == []
+    assert filesystem.copies == {}
+
+
+def test_only_files_that_may_match_are_hashed(create_temp_fs, monkeypatch):
+    source, dest = create_temp_fs
+    large = b"x" * (3 * BLOCKSIZE)
+    (Path(source) / "unique-size.bin").write_bytes(b"only file of its size")
+    (Path(source) / "large.bin").write_bytes(large)
+    (Path(dest) / "same-ends.bin").write_bytes(
+        large[:BLOCKSIZE] + b"y" * BLOCKSIZE + large[-BLOCKSIZE:]
+    )
+    (Path(dest) / "other-ends.bin").write_bytes(b"z" * (3 * BLOCKSIZE))
+
+    hashed = []
+    monkeypatch.setattr(
+        "sync.hash_file", lambda path, algorithm: hashed.append(path) or "digest"
+    )
+    source_hashes, dest_hashes = read_trees([source, dest])
+
+    assert sorted(os.path.basename(path) for path in hashed) == [
+        "large.bin",
+        "same-ends.bin",
+    ]
+    assert source_hashes.pop("directories") == set()
+    assert sorted(p for paths in source_hashes.values() for p in paths) == [
+        "large.bin",
+        "unique-size.bin",
+    ]
+    assert sorted(p for paths in dest_hashes.values() for p in paths) == [
+        "other-ends.bin",
+        "same-ends.bin",
+    ]
+
+
+def test_nested_tree_is_synced(create_temp_fs):
+    source, dest = create_temp_fs
+    (Path(source) / "a" / "b").mkdir(parents=True)
+    (Path(source) / "empty").mkdir()
+    (Path(source) / "a" / "b" / "fn1").write_text("one")
+    (Path(source) / "a" / "fn2").write_text("two")
+    (Path(source) / "a" / "copy").write_text("two")
+    (Path(source) / "c").write_text("three")
+    (Path(dest) / "c").mkdir()
+    (Path(dest) / "c" / "fn1").write_text("one")
+    (Path(dest) / "old").mkdir()
+    (Path(dest) / "old" / "stale").write_text("stale")
+
+    sync(source, dest, FileSystem())
+
+    def tree(root):
+        return {
+            str(path.relative_to(root)): path.read_text() if path.is_file() else None
+            for path in Path(root).rglob("*")
+        }
+
+    assert tree(dest) == tree(source)
+
+
+def test_files_swapped_in_source(create_temp_fs):
+    source, dest = create_temp_fs
+    (Path(source) / "fn1").write_text("two")
+    (Path(source) / "fn2").write_text("one")
+    (Path(dest) / "fn1").write_text("one")
+    (Path(dest) / "fn2").write_text("two")
+
+    sync(source, dest, FileSystem())
+
+    assert (Path(dest) / "fn1").read_text() == "two"
+    assert (Path(dest) / "fn2").read_text() == "one"
+    assert sorted(os.listdir(dest)) == ["fn1", "fn2"]
+
+
+def test_copy_reports_its_strategy(create_temp_fs):
+    source, dest = create_temp_fs
+    content = os.urandom(3 * BLOCKSIZE + 1)
+    (Path(source) / "fn1").write_bytes(content)
+
+    filesystem = FileSystem()
+    strategy = filesystem.copy(Path(source) / "fn1", Path(dest) / "fn1")
+
+    assert strategy in {"reflink", "copy_file_range", "sendfile", "shutil"}
+    assert filesystem.copies == {strategy: 1}
+    assert (Path(dest) / "fn1").read_bytes() == content
+
+
+def test_copy_falls_back_on_unsupported_strategies(create_temp_fs, monkeypatch):
+    source, dest = create_temp_fs
+    (Path(source) / "fn1").write_text("Hello Source World")
+
+    def unsupported(source_fd, destination_fd, size):
+        os.write(destination_fd, b"partial")
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr("sync.COPY_STRATEGIES", (("unsupported", unsupported),))
+    skipped = set()
+
+    assert copy_file(Path(source) / "fn1", Path(dest) / "fn1", skipped) == "shutil"
+    assert skipped == {"unsupported"}
+    assert (Path(dest) / "fn1").read_text() == "Hello Source World"
+
+
+def test_link_mode_hard_links_new_files(create_temp_fs):
+    source, dest = create_temp_fs
+    (Path(source) / "fn1").write_text("Hello Source World")
+
+    filesystem = FileSystem(link=True)
+    sync(source, dest, filesystem)
+
+    assert os.path.samefile(Path(source) / "fn1", Path(dest) / "fn1")
+    assert filesystem.copies == {"hardlink": 1}
@@ -1,24 +1,20 @@
 from abc import ABC
+from bisect import insort
 from dataclasses import dataclass
 from functools import reduce
-from typing import List
-
-from sqlalchemy_serializer import SerializerMixin
+from typing import Dict, List
 
 from domain.aggregates.base import AbstractAggregate
-from domain.events import OutOfStockEvent
+from domain.events import Event, OutOfStockEvent
 from domain.models import (
     Batch,
     DeallocateStocksException,
     InsufficientStocksException,
     Orderline,
+    eta_order,
 )
 
 
-class OutOfStock(Exception):
-    ...
-
-
 @dataclass
 class Product(AbstractAggregate):
     """
@@ -28,13 +24,67 @@ class Product(AbstractAggregate):
     sku: str
     batches: List[Batch]
     version: int
-    # events: List[str] = []
 
     def __init__(self, sku: str, batches: List[Batch], version: int = 0) -> None:
         self.sku = sku
         self.batches = batches
         self.version = version
-        # self.events = []
+        # batches ordered by allocation preference, None means it has to be
+        # rebuilt from batches on the next read
+        self._batches_by_eta = None
+        # orderid -> {line: batch} of every allocated line, an order can have
+        # several lines. Kept up to date by the methods of the aggregate, None
+        # means it has to be rebuilt from the batches on the next read, e.g.
+        # once the ORM (re)loaded them
+        self._allocations_index = None
+        # domain events raised since the aggregate was loaded, published by
+        # the unit of work once its changes are committed
+        self.events: List[Event] = []
+
+    @property
+    def batches_by_eta(self) -> List[Batch]:
+        """
+        The batches of this product in allocation preference order
+        """
+        if self._batches_by_eta is None or len(self._batches_by_eta) != len(
+            self.batches
+        ):
+            # batches was (re)populated without going through add_batch
+            self._batches_by_eta = sorted(self.batches, key=eta_order)
+        return self._batches_by_eta
+
+    @property
+    def allocations_index(self) -> Dict[str, Dict[Orderline, Batch]]:
+        if self._allocations_index is None:
+            index: Dict[str, Dict[Orderline, Batch]] = {}
+            for batch in self.batches:
+                for line in batch._allocations:
+                    index.setdefault(line.orderid, {})[line] = batch
+            self._allocations_index = index
+        return self._allocations_index
+
+    def _invalidate_indexes(self) -> None:
+        self._batches_by_eta = None
+        self._allocations_index = None
+
+    def allocated_batch(self, orderid: str) -> Batch | None:
+        """
+        Returns the batch the order is allocated to, if any, the first one
+        when its lines are in several batches
+        """
+        return next(iter(self.allocations_index.get(orderid, {}).values()), None)
+
+    def _unindex(self, line: Orderline) -> None:
+        allocations = self.allocations_index[line.orderid]
+        del allocations[line]
+        if not allocations:
+            del self.allocations_index[line.orderid]
+
+    def add_batch(self, batch: Batch) -> None:
+        batches_by_eta = self.batches_by_eta
+        self.batches.append(batch)
+        insort(batches_by_eta, batch, key=eta_order)
+        self.version += 1
 
     @property
     def available_quantity(self) -> int:
@@ -44,29 +94,43 @@ class Product(AbstractAggregate):
 
     def allocate(self, line: Orderline) -> str | None:
         try:
-            batch = next(b for b in self.batches if b.can_allocate(line))
+            batch = next(b for b in self.batches_by_eta if b.can_allocate(line))
             batch.allocate(line)
+            self.allocations_index.setdefault(line.orderid, {})[line] = batch
             self.version += 1
             return batch.reference
         except StopIteration:
-            raise OutOfStock(f"Out of stock for sku {line.sku}")
-            # self.events.append(OutOfStockEvent(sku=self.sku))
+            self.events.append(OutOfStockEvent(sku=self.sku))
             return None
 
     def deallocate(self, line: Orderline):
-        sorted_deallocatable_batch = [
-            batch_item
-            for batch_item in sorted(self.batches)
-            if batch_item._can_deallocate(line)
-        ]
+        batch = self.allocations_index.get(line.orderid, {}).get(line)
 
-        try:
-            deallocated_batch = next(iter(sorted_deallocatable_batch))
-            deallocated_batch.deallocate(line)
-            self.version += 1
-            return deallocated_batch.reference
-        except StopIteration:
+        if batch is None:
             # Not a business event, so raise an exception instead
             raise DeallocateStocksException(
                 f"No batches available to deallocate orderline {line.orderid}"
             )
+
+        batch.deallocate(line)
+        self._unindex(line)
+        self.version += 1
+        return batch.reference
+
+    def change_batch_quantity(self, reference: str, qty: int) -> List[Orderline]:
+        """
+        Changes the purchased quantity of a batch, deallocating lines until
+        it is no longer over allocated, and returns the deallocated lines
+        """
+        batch = next(batch for batch in self.batches if batch.reference == reference)
+        batch._purchased_quantity = qty
+        # built from the allocations before any of them is taken out
+        self.allocations_index
+
+        deallocated_lines = []
+        while batch.available_quantity < 0:
+            line = batch.deallocate_one()
+            self._unindex(line)
+            deallocated_lines.append(line)
+        self.version += 1
+        return deallocated_lines
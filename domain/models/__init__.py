@@ -5,5 +5,6 @@ from .batch import (
     InsufficientStocksException,
     allocate,
     deallocate,
+    eta_order,
 )
 from .order_line import Orderline
@@ -1,16 +1,7 @@
-from dataclasses import asdict, dataclass
-from typing import Set
+from dataclasses import dataclass
 
 
 @dataclass
 class Entity:
-    def to_json(self):
-        def serialize(v):
-            if isinstance(v, Set):
-                return list(v)
-            return v
-
-        return asdict(
-            self,
-            dict_factory=lambda fields: {f"{k}": serialize(v) for (k, v) in fields},
-        )
+    # serialized by infrastructure.serialization, see the schemas there
+    ...
@@ -1,9 +1,7 @@
 import json
 from dataclasses import asdict, dataclass, field
 from datetime import date
-from typing import Any, List, Optional, Set
-
-from sqlalchemy_serializer import SerializerMixin
+from typing import Any, List, Optional, Set, Tuple
 
 from domain.models.base import Entity
 from domain.models.order_line import Orderline
@@ -33,17 +31,26 @@ class Batch(Entity):
         self._purchased_quantity = qty
         self.eta = eta
         self._allocations = set()
+        # running total of the allocated quantity, None means it has to be
+        # rebuilt from _allocations on the next read
+        self._allocated_quantity = None
 
     @property
     def available_quantity(self):
         return self._purchased_quantity - self.allocated_quantity
 
     @property
-    def allocated_quantity(self):
-        sum_allocations = 0
-        for line in self._allocations:
-            sum_allocations += line.qty
-        return sum_allocations
+    def allocated_quantity(self) -> int:
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
+
+    def _invalidate_allocated_quantity(self) -> None:
+        """
+        Forces the allocated total to be rebuilt from _allocations,
+        used when the collection is (re)loaded from outside the domain
+        """
+        self._allocated_quantity = None
 
     def __eq__(self, __o: object) -> bool:
         if not isinstance(__o, Batch):
@@ -57,7 +64,9 @@ class Batch(Entity):
             return True
         if not isinstance(__o, Batch):
             raise ValueError("{__o} not of type Batch")
-        return self.eta > __o.eta  # type: ignore
+        if __o.eta is None:
+            return True
+        return self.eta > __o.eta
 
     def __hash__(self) -> int:
         return hash(self.reference)
@@ -68,10 +77,12 @@ class Batch(Entity):
             # already allocated, do nothing
             return
         if self.can_allocate(line):
+            allocated_quantity = self.allocated_quantity
             # if not self._order_exists(line):
             self._allocations.add(
                 line
             )  # I think this uses the __eq__ definition of the OrderLine
+            self._allocated_quantity = allocated_quantity + line.qty
         else:
             raise InsufficientStocksException(
                 f"Unable to allocate {line.qty} of {self.reference}, only {self.available_quantity} remaining "
@@ -88,35 +99,46 @@ class Batch(Entity):
         )
 
     def _can_deallocate(self, line: "Orderline") -> bool:
-        for order_line in self._allocations:
-            if order_line == line:
-                return True
-        return False
+        return line in self._allocations
 
     def deallocate(self, line) -> None:
         if self._can_deallocate(line):
+            allocated_quantity = self.allocated_quantity
             self._allocations.remove(line)
+            self._allocated_quantity = allocated_quantity - line.qty
         else:
             raise DeallocateStocksException("Stock not allocated")
 
     def deallocate_one(self) -> Orderline:
-        return self._allocations.pop()
+        allocated_quantity = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated_quantity - line.qty
+        return line
 
     def contains(self, line: "Orderline") -> bool:
-        return set([line]).issubset(self._allocations)
+        return line in self._allocations
+
+
+def eta_order(batch: Batch) -> Tuple[bool, date, str]:
+    """
+    Sort key of the batches in allocation preference order: in-stock batches
+    (no eta) first, then shipments by earliest eta. The reference only makes
+    the order deterministic
+    """
+    return (batch.eta is not None, batch.eta or date.min, batch.reference)
 
 
 # TODO: For deprecation. This is superceded by the aggregate method
 def allocate(order_line: "Orderline", batches: List[Batch]):
     allocated_batch = [batch for batch in batches if batch.contains(order_line)]
-    allocated_batch.sort()
+    allocated_batch.sort(key=eta_order)
 
     if len(allocated_batch) > 0:
         return allocated_batch[0]
 
     sorted_allocatable_batch = [
         batch_item
-        for batch_item in sorted(batches)  # also uses hash to sort by reference?
+        for batch_item in sorted(batches, key=eta_order)
         if batch_item.can_allocate(line=order_line)
     ]
 
@@ -1,12 +1,10 @@
 from dataclasses import dataclass
 
-from sqlalchemy_serializer import SerializerMixin
-
 from domain.models.base import Entity
 
 
 @dataclass(frozen=False)
-class Orderline(Entity, SerializerMixin):
+class Orderline(Entity):
     orderid: str
     sku: str
     qty: int
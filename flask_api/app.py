@@ -1,16 +1,56 @@
+import hashlib
 import json
-from dataclasses import asdict
+import os
+from contextlib import ExitStack
+from typing import Any, Dict, List
 
-from flask import Flask, request
+from flask import Flask, Response, request
+from flask.json.provider import JSONProvider
 
 from domain.models import InsufficientStocksException
+from infrastructure.cache import product_cache
+from infrastructure.database import get_pool_stats, read_only
+from infrastructure import LoadStrategy
 from infrastructure.orm import start_mappers
-from services.services import InvalidSkuError, allocate, deallocate, restock
-from services.unit_of_work import BatchUnitOfWork, ProductUnitOfWork
+from infrastructure.serialization import Schema, batch_schema, dumps, product_schema
+from services.outbox_relay import outbox_stats
+from services.services import (
+    InvalidSkuError,
+    allocate,
+    allocate_many,
+    deallocate,
+    restock,
+)
+from services.unit_of_work import (
+    BatchUnitOfWork,
+    ConcurrencyError,
+    ReadOnlyProductUnitOfWork,
+    retry_stats,
+)
+from services.views import allocation, availability
+from settings import global_settings
+
+
+class FastJSONProvider(JSONProvider):
+    """
+    Encodes the responses with infrastructure.serialization, straight to bytes
+    """
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return dumps(obj).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return json.loads(s, **kwargs)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype="application/json")
+
 
 # map the models to database tables and relationships
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 start_mappers()
 
 
@@ -22,17 +62,180 @@ start_mappers()
 #         return {"batches": batches}, 200
 
 
+@app.errorhandler(ConcurrencyError)
+def concurrency_error_handler(e: ConcurrencyError):
+    return {"message": str(e)}, 409
+
+
 @app.route("/ping", methods=["GET"])
 def ping():
     return "OK", 200
 
 
+@app.route("/stats", methods=["GET"])
+def stats_endpoint():
+    return {
+        "pid": os.getpid(),
+        "pool": get_pool_stats(),
+        "read_only_pool": get_pool_stats(read_only),
+        # only used by the product write paths, when enabled
+        "product_cache": (
+            product_cache.stats() if global_settings.PRODUCT_CACHE_ENABLED else None
+        ),
+        "retries": {
+            "retries": retry_stats.retries,
+            "failures": retry_stats.failures,
+        },
+        # shared by every process, the relays drain it
+        "outbox": outbox_stats(),
+    }, 200
+
+
+def _products_load_strategy(exclude: List[str]) -> LoadStrategy:
+    # do not load what is not going to be serialized
+    if "batches" in exclude:
+        return LoadStrategy.NONE
+    if "batches._allocations" in exclude:
+        return LoadStrategy.RAISE
+    return LoadStrategy.SELECTIN
+
+
+def _etag(*parts: Any) -> str:
+    return hashlib.md5("|".join(map(str, parts)).encode()).hexdigest()
+
+
+def _cache_headers(etag: str) -> Dict[str, str]:
+    # clients and caches revalidate with If-None-Match once max-age is over
+    return {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"public, max-age={global_settings.PRODUCTS_CACHE_MAX_AGE}",
+    }
+
+
+def _not_modified(etag: str) -> bool:
+    return request.if_none_match.contains_weak(etag)
+
+
 @app.route("/products", methods=["GET"])
 def get_products_endpoint():
-    uow = ProductUnitOfWork()
+    """
+    ?after=<sku>&limit=<n> returns a page of products, and the sku to pass as
+    after for the next one. Without limit the products are streamed.
+    ?exclude=<field>,... leaves fields out, e.g. batches._allocations
+    The ETag changes with the versions of the products in the response
+    """
+    after = request.args.get("after")
+    exclude = request.args.get("exclude", "")
+    paths = [path for path in exclude.split(",") if path]
+    try:
+        schema = product_schema.exclude(paths)
+    except KeyError as e:
+        return {"message": str(e.args[0])}, 400
+    strategy = _products_load_strategy(paths)
+
+    limit = None
+    if "limit" in request.args:
+        limit = request.args.get("limit", type=int)
+        if limit is None or not 0 < limit <= global_settings.PRODUCTS_MAX_PAGE_SIZE:
+            return {
+                "message": "limit must be between 1 and "
+                f"{global_settings.PRODUCTS_MAX_PAGE_SIZE}"
+            }, 400
+
+    if limit is None:
+        return _stream_products(after, exclude, schema, strategy)
+
+    uow = ReadOnlyProductUnitOfWork()
     with uow:
-        products = uow.repository.list()
-        return {"products": [product.to_json() for product in products]}, 200
+        # answers polling clients without loading any product
+        etag = _etag(uow.repository.version_digest(after, limit), limit, exclude)
+        if _not_modified(etag):
+            return "", 304, _cache_headers(etag)
+
+        products = uow.repository.list_page(after=after, limit=limit, strategy=strategy)
+        return (
+            {
+                "products": schema.dump_many(products),
+                "next": products[-1].sku if len(products) == limit else None,
+            },
+            200,
+            _cache_headers(etag),
+        )
+
+
+def _stream_products(
+    after: str | None, exclude: str, schema: Schema, strategy: LoadStrategy
+) -> Response:
+    # the ETag and the streamed products are read from the same snapshot, so
+    # the unit of work stays open until the response is sent
+    with ExitStack() as stack:
+        uow = ReadOnlyProductUnitOfWork(snapshot=True)
+        stack.enter_context(uow)
+        etag = _etag(uow.repository.version_digest(after), None, exclude)
+        if _not_modified(etag):
+            return Response(status=304, headers=_cache_headers(etag))
+
+        close = stack.pop_all().close
+
+    def generate():
+        try:
+            products = uow.repository.stream(
+                after=after,
+                chunk_size=global_settings.PRODUCTS_STREAM_CHUNK_SIZE,
+                strategy=strategy,
+            )
+            yield b'{"products":'
+            yield from schema.iterencode(products)
+            yield b"}"
+        finally:
+            close()
+
+    response = Response(generate(), mimetype="application/json")
+    response.headers.update(_cache_headers(etag))
+    # in case the response is not sent in full
+    response.call_on_close(close)
+    return response
+
+
+@app.route("/products/<sku>", methods=["GET"])
+def get_product_endpoint(sku: str):
+    exclude = request.args.get("exclude", "")
+    paths = [path for path in exclude.split(",") if path]
+    try:
+        schema = product_schema.exclude(paths)
+    except KeyError as e:
+        return {"message": str(e.args[0])}, 400
+
+    uow = ReadOnlyProductUnitOfWork()
+    with uow:
+        version = uow.repository.get_version(sku)
+        if version is None:
+            return {"message": f"Invalid sku: {sku}"}, 404
+        etag = _etag(sku, version, exclude)
+        if _not_modified(etag):
+            return "", 304, _cache_headers(etag)
+
+        strategy = _products_load_strategy(paths)
+        if strategy == LoadStrategy.SELECTIN:
+            strategy = LoadStrategy.JOINED
+        product = uow.repository.get(sku, strategy=strategy)
+        return schema.dump(product), 200, _cache_headers(etag)
+
+
+@app.route("/products/<sku>/availability", methods=["GET"])
+def get_availability_endpoint(sku: str):
+    available_quantity = availability(sku=sku, uow=ReadOnlyProductUnitOfWork())
+    if available_quantity is None:
+        return {"message": f"Invalid sku: {sku}"}, 404
+    return {"sku": sku, "available_quantity": available_quantity}, 200
+
+
+@app.route("/allocations/<orderid>", methods=["GET"])
+def get_allocation_endpoint(orderid: str):
+    result = allocation(orderid=orderid, uow=ReadOnlyProductUnitOfWork())
+    if result is None:
+        return {"message": f"Order {orderid} is not allocated"}, 404
+    return result, 200
 
 
 @app.route("/allocate", methods=["POST"])
@@ -42,13 +245,28 @@ def allocate_endpoint():
     qty = request.json["qty"]  # type: ignore
 
     try:
-        batchref = allocate(
-            order_id=order_id, sku=sku, quantity=qty, uow=BatchUnitOfWork()
+        batchref = BatchUnitOfWork().run(
+            allocate, order_id=order_id, sku=sku, quantity=qty
         )
     except (InsufficientStocksException, InvalidSkuError) as e:
         return {"message": str(e)}, 400
 
-    return {"batchref": asdict(batchref)}, 201
+    return {"batchref": batch_schema.dump(batchref)}, 201
+
+
+@app.route("/allocate/batch", methods=["POST"])
+def allocate_batch_endpoint():
+    try:
+        lines = [
+            (line["orderid"], line["sku"], line["qty"])
+            for line in request.json["lines"]  # type: ignore
+        ]
+    except (KeyError, TypeError) as e:
+        return {"message": f"Invalid request body: {e}"}, 400
+
+    results = BatchUnitOfWork().run(allocate_many, lines=lines)
+
+    return {"results": results}, 201
 
 
 @app.route("/deallocate", methods=["POST"])
@@ -58,11 +276,11 @@ def deallocate_endpoint():
     qty = request.json["qty"]  # type: ignore
 
     try:
-        batchref = deallocate(orderid=order_id, sku=sku, qty=qty, uow=BatchUnitOfWork())
+        batchref = BatchUnitOfWork().run(deallocate, orderid=order_id, sku=sku, qty=qty)
     except InvalidSkuError as e:
         return {"message": str(e)}, 400
 
-    return {"batchref": asdict(batchref)}, 201
+    return {"batchref": batch_schema.dump(batchref)}, 201
 
 
 @app.route("/restock", methods=["POST"])
@@ -75,11 +293,11 @@ def restock_endpoint():
     eta = body.get("eta")
 
     try:
-        batch = restock(
-            reference=reference, sku=name, qty=qty, eta=eta, uow=BatchUnitOfWork()
+        batch = BatchUnitOfWork().run(
+            restock, reference=reference, sku=name, qty=qty, eta=eta
         )
 
-        return {"batchref": batch.to_dict()}, 200
+        return {"batchref": batch_schema.dump(batch)}, 200
 
     except Exception as e:
         return {"message": str(e)}, 400
@@ -1,8 +1,12 @@
+from .outbox import AbstractOutbox, FakeOutbox, SqlAlchemyOutbox
+from .read_model import AbstractReadModel, FakeReadModel, SqlAlchemyReadModel
 from .repository import (
     AbstractRepository,
     BatchFakeRepository,
     BatchRepository,
+    CachedProductRepository,
     FakeRepository,
+    LoadStrategy,
     ProductFakeRepository,
     ProductRepository,
     SqlAlchemyRepository,
@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Generic, Tuple, TypeVar
+
+from settings import global_settings
+
+AggregateT = TypeVar("AggregateT")
+
+
+class AggregateCache(Generic[AggregateT]):
+    """
+    Per process LRU cache of aggregates detached from their session.
+    An aggregate is only handed out when its version matches the version
+    currently in the database, and it is taken out of the cache while in use
+    so that two units of work never share the same instance.
+    It is returned to the cache by `put` once its changes were committed.
+    """
+
+    def __init__(self, max_size: int = 128, ttl: float = 60) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (aggregate, version, time it was cached)
+        self._entries: OrderedDict[str, Tuple[AggregateT, int, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def take(self, key: str, version: int) -> AggregateT | None:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            aggregate, cached_version, cached_at = entry
+            if cached_version != version or time.monotonic() - cached_at > self.ttl:
+                # stale, modified elsewhere or too old to be trusted
+                self.misses += 1
+                self.evictions += 1
+                return None
+
+            self.hits += 1
+            return aggregate
+
+    def put(self, key: str, aggregate: AggregateT, version: int) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (aggregate, version, time.monotonic())
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                size=len(self._entries),
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
+
+
+product_cache: AggregateCache = AggregateCache(
+    max_size=global_settings.PRODUCT_CACHE_SIZE,
+    ttl=global_settings.PRODUCT_CACHE_TTL,
+)
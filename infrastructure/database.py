@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.base import OptionEngine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from settings import global_settings
+
+# The engine and its connection pool are created on first use, per process.
+# Nothing is connected at import time, so modules that never touch the
+# database (e.g. unit tests using the fake units of work) do not pay for it,
+# and a process forked after the engine was created (gunicorn --preload)
+# builds its own pool instead of sharing the parent's connections.
+
+
+class TimedQueuePool(QueuePool):
+    """
+    A QueuePool that records how long checkouts take to get a connection
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_wait_time = 0.0
+        self.max_checkout_wait_time = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.checkout_wait_time += waited
+                self.max_checkout_wait_time = max(self.max_checkout_wait_time, waited)
+
+
+def _connect_args() -> Dict[str, Any]:
+    statement_timeout = global_settings.DB_STATEMENT_TIMEOUT
+    if statement_timeout > 0:
+        # passed on to postgres as a session setting of every new connection
+        return {"options": f"-c statement_timeout={statement_timeout}"}
+    return {}
+
+
+def _create_engine(url: str, **kwargs) -> Engine:
+    return create_engine(
+        url=url,
+        # concurrent writes to a product are caught by its version checks, on
+        # commit for the Product aggregate (version_id_col) and by
+        # BatchRepository.bump_product_version for the batch write paths,
+        # so there is no need for a stricter isolation level
+        isolation_level="READ COMMITTED",
+        poolclass=TimedQueuePool,
+        pool_size=global_settings.DB_POOL_SIZE,
+        max_overflow=global_settings.DB_MAX_OVERFLOW,
+        pool_timeout=global_settings.DB_POOL_TIMEOUT,
+        pool_recycle=global_settings.DB_POOL_RECYCLE,
+        pool_pre_ping=global_settings.DB_POOL_PRE_PING,
+        connect_args=_connect_args(),
+        **kwargs,
+    )
+
+
+def _create_primary_engine() -> Engine:
+    return _create_engine(global_settings.DB_DSN)
+
+
+def _create_read_only_engine() -> Engine:
+    if not global_settings.DB_REPLICA_DSN:
+        # no replica, share the primary's pool but still refuse writes
+        return primary.get_engine().execution_options(postgresql_readonly=True)
+
+    return _create_engine(
+        global_settings.DB_REPLICA_DSN,
+        execution_options={"postgresql_readonly": True},
+    )
+
+
+class EngineProvider:
+    """
+    Lazily creates an engine and its session factory, once per process
+    """
+
+    def __init__(self, create_engine: Callable[[], Engine]) -> None:
+        self._create_engine = create_engine
+        self._lock = threading.Lock()
+        self._engine: Engine | None = None
+        self._session_factory: sessionmaker | None = None
+        self._pid: int | None = None
+
+    def get_engine(self) -> Engine:
+        if self._engine is not None and self._pid == os.getpid():
+            return self._engine
+
+        with self._lock:
+            if self._engine is None or self._pid != os.getpid():
+                self._engine = self._create_engine()
+                self._session_factory = sessionmaker(
+                    bind=self._engine,
+                    expire_on_commit=False,
+                    autocommit=False,
+                )
+                self._pid = os.getpid()
+        return self._engine
+
+    def get_session_factory(self) -> sessionmaker:
+        self.get_engine()
+        return self._session_factory  # type: ignore
+
+    def reset(self, close_connections: bool = True) -> None:
+        """
+        Drops the engine so the next use creates a new one.
+        In a forked child the pooled connections still belong to the parent,
+        so they are only discarded, never closed.
+        """
+        with self._lock:
+            # an OptionEngine shares the pool of the engine it was made from
+            if self._engine is not None and not isinstance(self._engine, OptionEngine):
+                self._engine.dispose(close=close_connections)
+            self._engine = None
+            self._session_factory = None
+            self._pid = None
+
+    def after_fork(self) -> None:
+        # the lock may have been held by another thread at the time of the fork
+        self._lock = threading.Lock()
+        self.reset(close_connections=False)
+
+
+primary = EngineProvider(_create_primary_engine)
+# used by the read only units of work, bound to DB_REPLICA_DSN if set
+read_only = EngineProvider(_create_read_only_engine)
+
+
+def get_engine() -> Engine:
+    return primary.get_engine()
+
+
+def get_session_factory() -> sessionmaker:
+    return primary.get_session_factory()
+
+
+def get_read_only_session_factory() -> sessionmaker:
+    return read_only.get_session_factory()
+
+
+def get_pool_stats(provider: EngineProvider = primary) -> Dict[str, Any]:
+    """
+    A snapshot of this process' connection pool usage
+    """
+    pool = provider.get_engine().pool
+    stats: Dict[str, Any] = {"status": pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    if isinstance(pool, TimedQueuePool):
+        stats.update(
+            checkouts=pool.checkouts,
+            checkout_wait_time=pool.checkout_wait_time,
+            max_checkout_wait_time=pool.max_checkout_wait_time,
+        )
+    return stats
+
+
+def reset_engine(close_connections: bool = True) -> None:
+    read_only.reset(close_connections=close_connections)
+    primary.reset(close_connections=close_connections)
+
+
+def _reset_after_fork() -> None:
+    read_only.after_fork()
+    primary.after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,7 +1,21 @@
 import logging
 from typing import Set
 
-from sqlalchemy import Column, Date, ForeignKey, Integer, MetaData, String, Table
+from sqlalchemy import (
+    JSON,
+    Column,
+    Date,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    event,
+    func,
+    inspect,
+)
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import clear_mappers, mapper, relationship
 
@@ -33,6 +47,8 @@ batch = Table(
     Column("sku", ForeignKey("product.sku")),
     Column("_purchased_quantity", Integer),
     Column("eta", Date),
+    # serves both the lookups by sku and the allocation ordering by eta
+    Index("ix_batch_sku_eta", "sku", "eta"),
 )
 
 # This serves as the many-to-many mapping between orderline and batch
@@ -40,8 +56,8 @@ allocations = Table(
     "allocations",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("orderline_id", ForeignKey("order_lines.orderid")),
-    Column("batch_id", ForeignKey("batch.reference")),
+    Column("orderline_id", ForeignKey("order_lines.orderid"), index=True),
+    Column("batch_id", ForeignKey("batch.reference"), index=True),
 )
 
 product = Table(
@@ -52,11 +68,64 @@ product = Table(
 )
 
 
+# Denormalised read model, see infrastructure.read_model
+allocations_view = Table(
+    "allocations_view",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("orderid", String(255), nullable=False, unique=True),
+    Column("sku", String(255), nullable=False),
+    Column("qty", Integer, nullable=False),
+    Column("batchref", String(255), nullable=False),
+)
+
+availability_view = Table(
+    "availability_view",
+    metadata,
+    Column("sku", String(255), primary_key=True, autoincrement=False),
+    Column("available_quantity", Integer, nullable=False),
+)
+
+# Events written in the same transaction as the aggregates that raised them,
+# relayed to the message bus handlers afterwards, see infrastructure.outbox
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("event_type", String(255), nullable=False),
+    Column("payload", JSON, nullable=False),
+    Column("created_at", DateTime, nullable=False, server_default=func.now()),
+    # failed deliveries, rows are deleted once the event is handled
+    Column("attempts", Integer, nullable=False, server_default="0"),
+)
+
+
 def create_tables(engine: Engine):
     metadata.create_all(engine, checkfirst=True)
 
 
+def _invalidate_allocated_quantity(batch: Batch | None, *args) -> None:
+    # the allocations collection was (re)populated by the ORM and not through
+    # the domain methods, so the running total has to be rebuilt
+    if batch is not None:
+        batch._invalidate_allocated_quantity()
+
+
+def _invalidate_product_indexes(product: Product | None, *args) -> None:
+    if product is not None:
+        product._invalidate_indexes()
+
+
+def _init_product_events(product: Product, *args) -> None:
+    # __init__ is not called for products loaded from the database
+    product.events = []
+
+
 def start_mappers():
+    if inspect(Product, raiseerr=False) is not None:
+        # already mapped, e.g. start_mappers called by both the app and tests
+        return
+
     lines_mapper = mapper(Orderline, order_lines)
     batch_mapper = mapper(
         Batch,
@@ -66,16 +135,26 @@ def start_mappers():
                 argument=lines_mapper,
                 secondary=allocations,
                 collection_class=set,
-                lazy="subquery",
+                lazy="selectin",
             )
         },
     )
+    for identifier in ("load", "refresh", "expire"):
+        event.listen(Batch, identifier, _invalidate_allocated_quantity)
+
     products_mapper = mapper(
         Product,
         product,
+        # the domain increments the version itself, the ORM only guards the
+        # UPDATE with "WHERE version = <version that was loaded>"
+        version_id_col=product.c.version,
+        version_id_generator=False,
         properties={
             "batches": relationship(
-                argument=batch_mapper, collection_class=list, lazy="subquery"
+                argument=batch_mapper, collection_class=list, lazy="selectin"
             )
         },
     )
+    for identifier in ("load", "refresh", "expire"):
+        event.listen(Product, identifier, _invalidate_product_indexes)
+    event.listen(Product, "load", _init_product_events)
@@ -0,0 +1,165 @@
+import json
+import time
+from abc import ABC, abstractmethod
+from dataclasses import asdict
+from typing import Dict, List, Tuple, Type
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from domain.events import Event
+
+# The outbox stores the domain events in the same transaction as the
+# aggregates that raised them, so an event is never lost once its changes
+# are committed and no message is ever sent for changes that were rolled back.
+# A relay (services.outbox_relay) claims the pending events afterwards and
+# hands them to the message bus handlers, deleting each one once handled.
+
+
+def _event_types() -> Dict[str, Type[Event]]:
+    return {event_type.__name__: event_type for event_type in Event.__subclasses__()}
+
+
+def serialize_event(event: Event) -> Tuple[str, Dict]:
+    return type(event).__name__, asdict(event)
+
+
+def deserialize_event(event_type: str, payload: Dict) -> Event:
+    return _event_types()[event_type](**payload)
+
+
+class AbstractOutbox(ABC):
+    @abstractmethod
+    def add(self, event: Event) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim(self, limit: int, max_attempts: int) -> List[Tuple[int, Event]]:
+        """
+        Returns up to limit pending events, oldest first, that failed fewer
+        than max_attempts times
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def mark_processed(self, ids: List[int]) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def mark_failed(self, ids: List[int]) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def stats(self, max_attempts: int) -> Dict[str, float]:
+        """
+        pending: events still to be relayed, given_up: events that failed
+        max_attempts times, lag: seconds since the oldest pending event was
+        added, 0 when there is none
+        """
+        raise NotImplementedError
+
+
+class SqlAlchemyOutbox(AbstractOutbox):
+    def __init__(self, session: Session) -> None:
+        self._session = session
+
+    def add(self, event: Event) -> None:
+        event_type, payload = serialize_event(event)
+        self._session.execute(
+            text(
+                """
+                INSERT INTO outbox (event_type, payload)
+                VALUES (:event_type, CAST(:payload AS JSON))
+                """
+            ),
+            dict(event_type=event_type, payload=json.dumps(payload)),
+        )
+
+    def claim(self, limit: int, max_attempts: int) -> List[Tuple[int, Event]]:
+        # the claimed rows stay locked until the session's transaction ends,
+        # concurrent relays skip them and claim the next ones instead
+        rows = self._session.execute(
+            text(
+                """
+                SELECT id, event_type, payload
+                FROM outbox
+                WHERE attempts < :max_attempts
+                ORDER BY id
+                LIMIT :limit
+                FOR UPDATE SKIP LOCKED
+                """
+            ),
+            dict(limit=limit, max_attempts=max_attempts),
+        )
+        return [
+            (row.id, deserialize_event(row.event_type, row.payload)) for row in rows
+        ]
+
+    def mark_processed(self, ids: List[int]) -> None:
+        if ids:
+            self._session.execute(
+                text("DELETE FROM outbox WHERE id = ANY(:ids)"), dict(ids=ids)
+            )
+
+    def mark_failed(self, ids: List[int]) -> None:
+        if ids:
+            self._session.execute(
+                text("UPDATE outbox SET attempts = attempts + 1 WHERE id = ANY(:ids)"),
+                dict(ids=ids),
+            )
+
+    def stats(self, max_attempts: int) -> Dict[str, float]:
+        row = self._session.execute(
+            text(
+                """
+                SELECT
+                    count(*) FILTER (WHERE attempts < :max_attempts) AS pending,
+                    count(*) FILTER (WHERE attempts >= :max_attempts) AS given_up,
+                    EXTRACT(EPOCH FROM LOCALTIMESTAMP - min(created_at)
+                        FILTER (WHERE attempts < :max_attempts)) AS lag
+                FROM outbox
+                """
+            ),
+            dict(max_attempts=max_attempts),
+        ).one()
+        return dict(pending=row.pending, given_up=row.given_up, lag=float(row.lag or 0))
+
+
+class FakeOutbox(AbstractOutbox):
+    def __init__(self) -> None:
+        self.events: Dict[int, Event] = {}
+        self.attempts: Dict[int, int] = {}
+        self.created_at: Dict[int, float] = {}
+        self._next_id = 1
+
+    def add(self, event: Event) -> None:
+        self.events[self._next_id] = event
+        self.attempts[self._next_id] = 0
+        self.created_at[self._next_id] = time.time()
+        self._next_id += 1
+
+    def claim(self, limit: int, max_attempts: int) -> List[Tuple[int, Event]]:
+        pending = [
+            (id, event)
+            for id, event in sorted(self.events.items())
+            if self.attempts[id] < max_attempts
+        ]
+        return pending[:limit]
+
+    def mark_processed(self, ids: List[int]) -> None:
+        for id in ids:
+            self.events.pop(id, None)
+            self.attempts.pop(id, None)
+            self.created_at.pop(id, None)
+
+    def mark_failed(self, ids: List[int]) -> None:
+        for id in ids:
+            self.attempts[id] += 1
+
+    def stats(self, max_attempts: int) -> Dict[str, float]:
+        pending = [id for id in self.events if self.attempts[id] < max_attempts]
+        return dict(
+            pending=len(pending),
+            given_up=len(self.events) - len(pending),
+            lag=max((time.time() - self.created_at[id] for id in pending), default=0),
+        )
@@ -0,0 +1,118 @@
+from abc import ABC, abstractmethod
+from typing import Dict
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+# The read model is a denormalised copy of the allocations and of the
+# available quantity of every sku, kept up to date by the service layer in
+# the same transaction as the aggregates it mirrors.
+# Queries answer from it with a single indexed SELECT instead of loading
+# whole Product/Batch aggregates.
+
+
+class AbstractReadModel(ABC):
+    @abstractmethod
+    def add_allocation(self, orderid: str, sku: str, qty: int, batchref: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_allocation(self, orderid: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def adjust_available_quantity(self, sku: str, delta: int) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_allocation(self, orderid: str) -> Dict | None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_available_quantity(self, sku: str) -> int | None:
+        raise NotImplementedError
+
+
+class SqlAlchemyReadModel(AbstractReadModel):
+    def __init__(self, session: Session) -> None:
+        self._session = session
+
+    def add_allocation(self, orderid: str, sku: str, qty: int, batchref: str) -> None:
+        self._session.execute(
+            text(
+                """
+                INSERT INTO allocations_view (orderid, sku, qty, batchref)
+                VALUES (:orderid, :sku, :qty, :batchref)
+                ON CONFLICT (orderid) DO UPDATE
+                SET sku = EXCLUDED.sku, qty = EXCLUDED.qty, batchref = EXCLUDED.batchref
+                """
+            ),
+            dict(orderid=orderid, sku=sku, qty=qty, batchref=batchref),
+        )
+
+    def remove_allocation(self, orderid: str) -> None:
+        self._session.execute(
+            text("DELETE FROM allocations_view WHERE orderid = :orderid"),
+            dict(orderid=orderid),
+        )
+
+    def adjust_available_quantity(self, sku: str, delta: int) -> None:
+        # applied as an increment so concurrent transactions on the same sku
+        # do not overwrite each other's changes
+        self._session.execute(
+            text(
+                """
+                INSERT INTO availability_view (sku, available_quantity)
+                VALUES (:sku, :delta)
+                ON CONFLICT (sku) DO UPDATE
+                SET available_quantity = availability_view.available_quantity + :delta
+                """
+            ),
+            dict(sku=sku, delta=delta),
+        )
+
+    def get_allocation(self, orderid: str) -> Dict | None:
+        row = (
+            self._session.execute(
+                text(
+                    """
+                    SELECT orderid, sku, qty, batchref
+                    FROM allocations_view
+                    WHERE orderid = :orderid
+                    """
+                ),
+                dict(orderid=orderid),
+            )
+            .mappings()
+            .first()
+        )
+        return dict(row) if row else None
+
+    def get_available_quantity(self, sku: str) -> int | None:
+        return self._session.execute(
+            text("SELECT available_quantity FROM availability_view WHERE sku = :sku"),
+            dict(sku=sku),
+        ).scalar()
+
+
+class FakeReadModel(AbstractReadModel):
+    def __init__(self) -> None:
+        self.allocations: Dict[str, Dict] = {}
+        self.available_quantities: Dict[str, int] = {}
+
+    def add_allocation(self, orderid: str, sku: str, qty: int, batchref: str) -> None:
+        self.allocations[orderid] = dict(
+            orderid=orderid, sku=sku, qty=qty, batchref=batchref
+        )
+
+    def remove_allocation(self, orderid: str) -> None:
+        self.allocations.pop(orderid, None)
+
+    def adjust_available_quantity(self, sku: str, delta: int) -> None:
+        self.available_quantities[sku] = self.available_quantities.get(sku, 0) + delta
+
+    def get_allocation(self, orderid: str) -> Dict | None:
+        return self.allocations.get(orderid)
+
+    def get_available_quantity(self, sku: str) -> int | None:
+        return self.available_quantities.get(sku)
@@ -1,13 +1,17 @@
+import hashlib
 from abc import ABC, abstractmethod
-from typing import Any, Generic, List, Type, TypeVar, Union
+from enum import Enum
+from typing import Any, Dict, Generic, Iterator, List, Set, Type, TypeVar, Union
 
-from sqlalchemy import String, cast
-from sqlalchemy.orm import Session
+from sqlalchemy import String, cast, text
+from sqlalchemy.orm import Query, Session, joinedload, raiseload, selectinload
+from sqlalchemy.orm.attributes import InstrumentedAttribute
 
 from domain.aggregates import Product
 from domain.aggregates.base import AbstractAggregate
-from domain.models import Batch
+from domain.models import Batch, Orderline
 from domain.models.base import Entity
+from infrastructure.cache import AggregateCache
 
 # This module encapsulates the way of communicating with a specific database by means of an interface
 # which in this case, is the AbstractRepository.
@@ -19,17 +23,76 @@ AggregateOrEntityT = TypeVar(
 )
 
 
+class LoadStrategy(str, Enum):
+    """
+    How the entities held by an aggregate are loaded alongside it
+    """
+
+    # one extra SELECT ... WHERE id IN (...) per relationship, best when
+    # loading many aggregates
+    SELECTIN = "selectin"
+    # a single SELECT with LEFT OUTER JOINs, best for a single aggregate
+    JOINED = "joined"
+    # loads everything but the innermost relationship (the allocations),
+    # which raises if accessed, for write paths that never touch it
+    RAISE = "raise"
+    # loads the aggregate alone, every relationship raises if accessed
+    NONE = "none"
+
+
 class AbstractRepository(ABC, Generic[AggregateOrEntityT]):
+    # aggregates added or loaded through this repository, the unit of work
+    # collects their domain events from here
+    seen: List[AggregateOrEntityT]
+
     @abstractmethod
     def add(self, aggregate: AggregateOrEntityT) -> None:
         raise NotImplementedError
 
     @abstractmethod
-    def get(self, reference: Any) -> AggregateOrEntityT:
+    def get(
+        self, reference: Any, strategy: LoadStrategy = LoadStrategy.JOINED
+    ) -> AggregateOrEntityT:
         raise NotImplementedError
 
     @abstractmethod
-    def list(self) -> list[AggregateOrEntityT]:
+    def list(
+        self, strategy: LoadStrategy = LoadStrategy.SELECTIN
+    ) -> list[AggregateOrEntityT]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_for_sku(
+        self, sku: str, strategy: LoadStrategy = LoadStrategy.SELECTIN
+    ) -> List[AggregateOrEntityT]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_page(
+        self,
+        after: str | None = None,
+        limit: int = 100,
+        strategy: LoadStrategy = LoadStrategy.SELECTIN,
+    ) -> List[AggregateOrEntityT]:
+        """
+        Returns up to limit aggregates ordered by their identifier, starting
+        after the given identifier (keyset pagination)
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def stream(
+        self,
+        after: str | None = None,
+        chunk_size: int = 100,
+        strategy: LoadStrategy = LoadStrategy.SELECTIN,
+    ) -> Iterator[AggregateOrEntityT]:
+        """
+        Yields the aggregates ordered by their identifier, without holding
+        more than chunk_size of them in memory. They are meant to be read and
+        let go: they are not tracked in seen and are detached from the
+        session once the next chunk is fetched
+        """
         raise NotImplementedError
 
 
@@ -44,18 +107,109 @@ class SqlAlchemyRepository(AbstractRepository, Generic[AggregateOrEntityT]):
     def _aggregate(self) -> Type[AggregateOrEntityT]:
         ...
 
+    @property
+    def _relationships(self) -> List[InstrumentedAttribute]:
+        """
+        The chain of relationships loaded with the aggregate, outermost first
+        """
+        return []
+
+    @property
+    @abstractmethod
+    def _identifier(self) -> InstrumentedAttribute:
+        """
+        The unique column the aggregates are ordered and paginated by
+        """
+        ...
+
     def __init__(self, session: Session) -> None:
         super().__init__()
         self._session = session
+        self.seen = []
+
+    def _query(self, strategy: LoadStrategy) -> Query:
+        query = self._session.query(self._aggregate)
+        if strategy == LoadStrategy.NONE:
+            if not self._relationships:
+                return query
+            return query.options(raiseload(self._relationships[0]))
+
+        loader = joinedload if strategy == LoadStrategy.JOINED else selectinload
+        option = None
+        for depth, relationship in enumerate(self._relationships, start=1):
+            relationship_loader = loader
+            if strategy == LoadStrategy.RAISE and depth == len(self._relationships):
+                relationship_loader = raiseload
+            option = (
+                relationship_loader(relationship)
+                if option is None
+                # chain the loader onto the previous relationship
+                else getattr(option, relationship_loader.__name__)(relationship)
+            )
+
+        return query if option is None else query.options(option)
 
     def add(self, batch: AggregateOrEntityT):
         self._session.add(batch)
+        self.seen.append(batch)
+
+    def get(
+        self, sku: str, strategy: LoadStrategy = LoadStrategy.JOINED
+    ) -> AggregateOrEntityT:
+        aggregate = self._query(strategy).filter_by(sku=sku).one()
+        self.seen.append(aggregate)
+        return aggregate
 
-    def get(self, sku: str) -> AggregateOrEntityT:
-        return self._session.query(self._aggregate).filter_by(sku=sku).one()
+    def list(
+        self, strategy: LoadStrategy = LoadStrategy.SELECTIN
+    ) -> List[AggregateOrEntityT]:
+        aggregates = self._query(strategy).all()
+        self.seen.extend(aggregates)
+        return aggregates
 
-    def list(self) -> List[AggregateOrEntityT]:
-        return self._session.query(self._aggregate).all()
+    def list_for_sku(
+        self, sku: str, strategy: LoadStrategy = LoadStrategy.SELECTIN
+    ) -> List[AggregateOrEntityT]:
+        # scope the query to a single product so the cost of loading
+        # does not grow with the size of the whole warehouse
+        aggregates = self._query(strategy).filter_by(sku=sku).all()
+        self.seen.extend(aggregates)
+        return aggregates
+
+    def _page_query(self, after: str | None, strategy: LoadStrategy) -> Query:
+        query = self._query(strategy)
+        if after is not None:
+            query = query.filter(self._identifier > after)
+        return query.order_by(self._identifier)
+
+    def list_page(
+        self,
+        after: str | None = None,
+        limit: int = 100,
+        strategy: LoadStrategy = LoadStrategy.SELECTIN,
+    ) -> List[AggregateOrEntityT]:
+        aggregates = self._page_query(after, strategy).limit(limit).all()
+        self.seen.extend(aggregates)
+        return aggregates
+
+    def stream(
+        self,
+        after: str | None = None,
+        chunk_size: int = 100,
+        strategy: LoadStrategy = LoadStrategy.SELECTIN,
+    ) -> Iterator[AggregateOrEntityT]:
+        if strategy == LoadStrategy.JOINED:
+            # joined eager loading of collections cannot be used with yield_per
+            strategy = LoadStrategy.SELECTIN
+        # yield_per fetches the rows from a server side cursor chunk by chunk
+        query = self._page_query(after, strategy).yield_per(chunk_size)
+        for count, aggregate in enumerate(query, start=1):
+            yield aggregate
+            if count % chunk_size == 0:
+                # let go of the chunk that was just read, expunge_all would
+                # replace the identity map the query is still loading into
+                for instance in list(self._session.identity_map.values()):
+                    self._session.expunge(instance)
 
 
 # This is an antipattern! Repositories should be returning just aggregates! not Entities!
@@ -65,12 +219,88 @@ class BatchRepository(SqlAlchemyRepository[Batch]):
     def _aggregate(self) -> Type[Batch]:
         return Batch
 
-    def get(self, reference: str) -> Batch:
-        return (
-            self._session.query(self._aggregate)
-            .filter_by(reference=cast(reference, String))
-            .one()
+    @property
+    def _relationships(self) -> List[InstrumentedAttribute]:
+        return [Batch._allocations]  # type: ignore
+
+    @property
+    def _identifier(self) -> InstrumentedAttribute:
+        return Batch.reference  # type: ignore
+
+    def get(
+        self, reference: str, strategy: LoadStrategy = LoadStrategy.JOINED
+    ) -> Batch:
+        batch = self._query(strategy).filter_by(reference=cast(reference, String)).one()
+        self.seen.append(batch)
+        return batch
+
+    def get_allocated(
+        self, line: Orderline, strategy: LoadStrategy = LoadStrategy.JOINED
+    ) -> Batch | None:
+        """
+        The batch the order line is allocated to, if any, looked up through
+        the indexed allocations instead of loading every batch of the sku
+        """
+        batch = (
+            self._query(strategy)
+            .filter_by(sku=line.sku)
+            .filter(
+                Batch._allocations.any(  # type: ignore
+                    orderid=line.orderid, sku=line.sku, qty=line.qty
+                )
+            )
+            .first()
         )
+        if batch is not None:
+            self.seen.append(batch)
+        return batch
+
+    def existing_orderids(self, orderids: List[str]) -> Set[str]:
+        """
+        The given orderids that already have an order line, allocated or not
+        """
+        if not orderids:
+            return set()
+        rows = self._session.execute(
+            text("SELECT orderid FROM order_lines WHERE orderid = ANY(:orderids)"),
+            dict(orderids=orderids),
+        )
+        return {row.orderid for row in rows}
+
+    def get_product_version(self, sku: str) -> int | None:
+        """
+        The version of the product of the batches, to read before the batches
+        themselves and pass to bump_product_version once they are changed
+        """
+        return self._session.execute(
+            text("SELECT version FROM product WHERE sku = :sku"), dict(sku=sku)
+        ).scalar()
+
+    def bump_product_version(self, sku: str, version: int) -> bool:
+        """
+        Increments the version of the product of the batches, so that their
+        changes are seen by whatever relies on it (caches, ETags, optimistic
+        locking) even though they are not made through the Product aggregate.
+        Returns False, and changes nothing, when the version is no longer the
+        given one: another transaction changed the product since its batches
+        were read, so the changes made from them cannot be committed
+        """
+        # a concurrent writer waits for the row lock, then finds the new version
+        result = self._session.execute(
+            text(
+                """
+                UPDATE product SET version = version + 1
+                WHERE sku = :sku AND version = :version
+                """
+            ),
+            dict(sku=sku, version=version),
+        )
+        return result.rowcount == 1
+
+
+def _version_digest(versions: List[str]) -> str:
+    # same digest as the one computed in SQL by ProductRepository
+    return hashlib.md5(",".join(versions).encode()).hexdigest()
 
 
 class ProductRepository(SqlAlchemyRepository[Product]):
@@ -78,6 +308,84 @@ class ProductRepository(SqlAlchemyRepository[Product]):
     def _aggregate(self) -> Type[Product]:
         return Product
 
+    @property
+    def _relationships(self) -> List[InstrumentedAttribute]:
+        return [Product.batches, Batch._allocations]  # type: ignore
+
+    @property
+    def _identifier(self) -> InstrumentedAttribute:
+        return Product.sku  # type: ignore
+
+    def get_version(self, sku: str) -> int | None:
+        """
+        The current version of the product, without loading it
+        """
+        return self._session.execute(
+            text("SELECT version FROM product WHERE sku = :sku"), dict(sku=sku)
+        ).scalar()
+
+    def version_digest(self, after: str | None = None, limit: int | None = None) -> str:
+        """
+        A digest of the skus and versions of the products list_page (or
+        stream, without limit) would return, changes whenever one of them does
+        """
+        return self._session.execute(
+            text(
+                """
+                SELECT md5(COALESCE(string_agg(sku || ':' || version, ',' ORDER BY sku), ''))
+                FROM (
+                    SELECT sku, version
+                    FROM product
+                    WHERE CAST(:after AS VARCHAR) IS NULL OR sku > :after
+                    ORDER BY sku
+                    LIMIT :limit
+                ) AS page
+                """
+            ),
+            dict(after=after, limit=limit),
+        ).scalar()
+
+
+class CachedProductRepository(ProductRepository):
+    """
+    A ProductRepository reusing the Products of previous units of work,
+    as long as the version in the database did not change.
+    This is only safe while every write to a product increments its version,
+    either through the Product aggregate or with
+    BatchRepository.bump_product_version.
+    """
+
+    def __init__(self, session: Session, cache: AggregateCache[Product]) -> None:
+        super().__init__(session)
+        self._cache = cache
+        # products of this unit of work that may go back in the cache
+        self._seen: dict[str, Product] = {}
+
+    def get(self, sku: str, strategy: LoadStrategy = LoadStrategy.JOINED) -> Product:
+        version = self.get_version(sku)
+
+        product = self._cache.take(sku, version) if version is not None else None
+        if product is not None:
+            # reattach the detached product, no rows are loaded
+            self._session.add(product)
+            self.seen.append(product)
+        else:
+            product = super().get(sku, strategy)
+            if strategy == LoadStrategy.RAISE:
+                # not fully loaded, cannot be reused by other units of work
+                return product
+
+        self._seen[sku] = product
+        return product
+
+    def release(self) -> None:
+        """
+        Puts the products back in the cache, once their changes are committed
+        """
+        for sku, product in self._seen.items():
+            self._cache.put(sku, product, product.version)
+        self._seen.clear()
+
 
 class FakeRepository(AbstractRepository, Generic[AggregateOrEntityT]):
     @abstractmethod
@@ -86,25 +394,98 @@ class FakeRepository(AbstractRepository, Generic[AggregateOrEntityT]):
 
     def __init__(self, initial_data: List[AggregateOrEntityT] | None = None) -> None:
         self._data = initial_data or []
+        self.seen = []
         super().__init__()
 
     def add(self, aggregate: AggregateOrEntityT) -> None:
         self._data.append(aggregate)
+        self.seen.append(aggregate)
 
-    def get(self, reference: str) -> AggregateOrEntityT:
+    def get(
+        self, reference: str, strategy: LoadStrategy = LoadStrategy.JOINED
+    ) -> AggregateOrEntityT:
         items = [i for i in self._data if self._get_identifier(i) == reference]
         items = iter(items)
-        return next(items)
+        item = next(items)
+        self.seen.append(item)
+        return item
 
-    def list(self) -> List[AggregateOrEntityT]:
+    def list(
+        self, strategy: LoadStrategy = LoadStrategy.SELECTIN
+    ) -> List[AggregateOrEntityT]:
+        self.seen.extend(self._data)
         return self._data
 
+    def list_for_sku(
+        self, sku: str, strategy: LoadStrategy = LoadStrategy.SELECTIN
+    ) -> List[AggregateOrEntityT]:
+        items = [i for i in self._data if i.sku == sku]
+        self.seen.extend(items)
+        return items
+
+    def _page(self, after: str | None) -> List[AggregateOrEntityT]:
+        items = sorted(self._data, key=self._get_identifier)
+        if after is None:
+            return items
+        return [i for i in items if self._get_identifier(i) > after]
+
+    def list_page(
+        self,
+        after: str | None = None,
+        limit: int = 100,
+        strategy: LoadStrategy = LoadStrategy.SELECTIN,
+    ) -> List[AggregateOrEntityT]:
+        items = self._page(after)[:limit]
+        self.seen.extend(items)
+        return items
+
+    def stream(
+        self,
+        after: str | None = None,
+        chunk_size: int = 100,
+        strategy: LoadStrategy = LoadStrategy.SELECTIN,
+    ) -> Iterator[AggregateOrEntityT]:
+        yield from self._page(after)
+
 
 class ProductFakeRepository(FakeRepository[Product]):
     def _get_identifier(self, item: Product):
         return item.sku
 
+    def get_version(self, sku: str) -> int | None:
+        return next((p.version for p in self._data if p.sku == sku), None)
+
+    def version_digest(self, after: str | None = None, limit: int | None = None) -> str:
+        products = self._page(after)[:limit]
+        return _version_digest([f"{p.sku}:{p.version}" for p in products])
+
 
 class BatchFakeRepository(FakeRepository[Batch]):
     def _get_identifier(self, item: Batch):
         return item.reference
+
+    def __init__(self, initial_data: List[Batch] | None = None) -> None:
+        super().__init__(initial_data)
+        # sku -> version of the product, incremented by bump_product_version
+        self.product_versions: Dict[str, int] = {}
+
+    def get_allocated(
+        self, line: Orderline, strategy: LoadStrategy = LoadStrategy.JOINED
+    ) -> Batch | None:
+        batch = next((i for i in self._data if i.contains(line)), None)
+        if batch is not None:
+            self.seen.append(batch)
+        return batch
+
+    def existing_orderids(self, orderids: List[str]) -> Set[str]:
+        lines = {line for batch in self._data for line in batch._allocations}
+        return {line.orderid for line in lines} & set(orderids)
+
+    def get_product_version(self, sku: str) -> int | None:
+        return self.product_versions.get(sku, 0)
+
+    def bump_product_version(self, sku: str, version: int) -> bool:
+        if self.get_product_version(sku) != version:
+            return False
+        self.product_versions[sku] = version + 1
+        return True
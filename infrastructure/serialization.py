@@ -0,0 +1,141 @@
+import json
+from dataclasses import dataclass, fields, is_dataclass, replace
+from datetime import date
+from operator import attrgetter
+from typing import Any, Callable, Dict, Iterable, Iterator, Tuple
+
+from domain.aggregates import Product
+from domain.models import Batch, Orderline
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Schema driven serialization of the aggregates for the API responses.
+# Each schema reads the attributes it lists straight off the objects and
+# builds the plain dicts/lists in one pass, nothing is copied beforehand.
+
+
+@dataclass(frozen=True)
+class Field:
+    name: str
+    attribute: str | None = None
+    # schema of the object(s) held by the attribute, when they are not scalars
+    schema: "Schema | None" = None
+    many: bool = False
+
+
+class Schema:
+    def __init__(self, *fields: Field) -> None:
+        self.fields = fields
+        self._getters: Tuple[Tuple[str, Callable[[Any], Any]], ...] = tuple(
+            (field.name, self._getter(field)) for field in fields
+        )
+
+    @staticmethod
+    def _getter(field: Field) -> Callable[[Any], Any]:
+        get = attrgetter(field.attribute or field.name)
+        if field.schema is None:
+            return get
+        dump = field.schema.dump
+        if field.many:
+            return lambda obj: [dump(item) for item in get(obj)]
+        return lambda obj: None if (value := get(obj)) is None else dump(value)
+
+    def dump(self, obj: Any) -> Dict[str, Any]:
+        return {name: get(obj) for name, get in self._getters}
+
+    def dump_many(self, objs: Iterable[Any]) -> list:
+        dump = self.dump
+        return [dump(obj) for obj in objs]
+
+    def iterencode(self, objs: Iterable[Any]) -> Iterator[bytes]:
+        """
+        Encodes the objects as a JSON array one at a time, for streaming
+        """
+        dump = self.dump
+        separator = b"["
+        for obj in objs:
+            yield separator + dumps(dump(obj))
+            separator = b","
+        yield b"[]" if separator == b"[" else b"]"
+
+    def exclude(self, paths: Iterable[str]) -> "Schema":
+        """
+        Returns a schema without the given fields, nested fields are given
+        as dotted paths, e.g. "batches._allocations"
+        """
+        excluded, nested = set(), {}
+        for path in paths:
+            name, _, rest = path.partition(".")
+            if rest:
+                nested.setdefault(name, []).append(rest)
+            else:
+                excluded.add(name)
+
+        names = {field.name for field in self.fields}
+        unknown = (excluded | nested.keys()) - names
+        if unknown:
+            raise KeyError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+        fields_ = []
+        for field in self.fields:
+            if field.name in excluded:
+                continue
+            if field.name in nested:
+                if field.schema is None:
+                    raise KeyError(f"Field {field.name} has no nested fields")
+                field = replace(field, schema=field.schema.exclude(nested[field.name]))
+            fields_.append(field)
+        return Schema(*fields_)
+
+
+orderline_schema = Schema(Field("orderid"), Field("sku"), Field("qty"))
+
+batch_schema = Schema(
+    Field("sku"),
+    Field("reference"),
+    Field("_purchased_quantity"),
+    Field("eta"),
+    Field("_allocations", schema=orderline_schema, many=True),
+)
+
+product_schema = Schema(
+    Field("sku"),
+    Field("batches", schema=batch_schema, many=True),
+    Field("version"),
+)
+
+SCHEMAS: Dict[type, Schema] = {
+    Orderline: orderline_schema,
+    Batch: batch_schema,
+    Product: product_schema,
+}
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    schema = SCHEMAS.get(type(value))
+    if schema is not None:
+        return schema.dump(value)
+    if is_dataclass(value):
+        # shallow, the encoder comes back here for nested values if needed
+        return {field.name: getattr(value, field.name) for field in fields(value)}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(payload: Any) -> bytes:
+    """
+    Encodes a payload to JSON bytes, aggregates found in it are serialized
+    with their schema. Uses orjson when it is installed
+    """
+    if orjson is not None:
+        # dataclasses go through _default so that they follow their schema
+        return orjson.dumps(
+            payload, default=_default, option=orjson.OPT_PASSTHROUGH_DATACLASS
+        )
+    return json.dumps(payload, default=_default, separators=(",", ":")).encode()
@@ -1,6 +1,11 @@
 from .unit_of_work import (
     AbstractUnitOfWork,
     BatchUnitOfWork,
+    ConcurrencyError,
     ProductUnitOfWork,
+    ReadOnlyProductUnitOfWork,
+    ReadOnlyUnitOfWorkError,
+    RetryPolicy,
     SqlAlchemyUnitOfWork,
+    retry_stats,
 )
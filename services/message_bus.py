@@ -1,14 +1,263 @@
-from typing import Callable, Dict, List, Type
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from typing import Callable, Dict, Hashable, List, Tuple, Type
 
 from domain.events import Event, OutOfStockEvent
+from settings import global_settings
 
-HANDLERS: Dict[Type[Event], List[Callable]] = {OutOfStockEvent: []}
+logger = logging.getLogger(__name__)
 
 
-def handle_event(event: Event):
-    for handler in HANDLERS[type(event)]:
-        handler(event)
+def batch_handler(handler: Callable) -> Callable:
+    """
+    Marks a handler as accepting a list of events of its type, the bus then
+    delivers all the events it has at hand in a single call
+    """
+    handler.accepts_batches = True  # type: ignore
+    return handler
 
 
-def send_out_of_stock_notification(event: Event):
-    print(f"Sending an email for event: {event}")
+@batch_handler
+def send_out_of_stock_notification(events: List[OutOfStockEvent]):
+    print(f"Sending an email for events: {events}")
+
+
+HANDLERS: Dict[Type[Event], List[Callable]] = {
+    OutOfStockEvent: [send_out_of_stock_notification]
+}
+
+
+@dataclass(frozen=True)
+class Coalescing:
+    """
+    Events of a type sharing the same key are delivered at most once per
+    window seconds, the others are dropped
+    """
+
+    key: Callable[[Event], Hashable]
+    window: float
+
+
+COALESCING: Dict[Type[Event], Coalescing] = {
+    OutOfStockEvent: Coalescing(
+        key=lambda event: event.sku,
+        window=global_settings.OUT_OF_STOCK_NOTIFICATION_WINDOW,
+    )
+}
+
+
+class Coalescer:
+    """
+    Remembers which events each handler was given, to drop the events of
+    the same key that follow within the window of their type.
+    Deliveries are tracked per handler: when only some of the handlers of an
+    event fail, only those are released and get the event again on retry.
+    The state is kept in memory, per process: each relay process coalesces
+    the events it relays on its own.
+    """
+
+    def __init__(
+        self,
+        policies: Dict[Type[Event], Coalescing] = COALESCING,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.policies = policies
+        self._clock = clock
+        self._lock = threading.Lock()
+        # (handler, event type, key) -> when the handler was last given an
+        # event with that key
+        self._delivered: Dict[Tuple[Callable, Type[Event], Hashable], float] = {}
+        self._prune_at = 1024
+        self.coalesced = 0
+
+    def _key(
+        self, handler: Callable, event: Event
+    ) -> Tuple[Callable, Type[Event], Hashable] | None:
+        policy = self.policies.get(type(event))
+        return None if policy is None else (handler, type(event), policy.key(event))
+
+    def coalesce(self, handler: Callable, events: List[Event]) -> List[Event]:
+        """
+        Returns the events to hand to the handler, it was given the others
+        recently
+        """
+        now = self._clock()
+        kept = []
+        with self._lock:
+            for event in events:
+                key = self._key(handler, event)
+                if key is not None:
+                    delivered_at = self._delivered.get(key)
+                    window = self.policies[type(event)].window
+                    if delivered_at is not None and now - delivered_at < window:
+                        self.coalesced += 1
+                        continue
+                    self._delivered[key] = now
+                kept.append(event)
+            if len(self._delivered) > self._prune_at:
+                self._prune(now)
+        return kept
+
+    def release(self, handler: Callable, events: List[Event]) -> None:
+        """
+        Forgets the handler was given the events, e.g. when it failed on
+        them and they will be retried
+        """
+        with self._lock:
+            for event in events:
+                key = self._key(handler, event)
+                if key is not None:
+                    self._delivered.pop(key, None)
+
+    def _prune(self, now: float) -> None:
+        self._delivered = {
+            key: delivered_at
+            for key, delivered_at in self._delivered.items()
+            if now - delivered_at < self.policies[key[1]].window
+        }
+        self._prune_at = max(1024, 2 * len(self._delivered))
+
+
+coalescer = Coalescer()
+
+
+def _group_by_type(events: List[Event]) -> Dict[Type[Event], List[Event]]:
+    groups: Dict[Type[Event], List[Event]] = {}
+    for event in events:
+        groups.setdefault(type(event), []).append(event)
+    return groups
+
+
+Call = Tuple[Callable, Event | List[Event]]
+
+
+def _calls(
+    handlers: Dict[Type[Event], List[Callable]],
+    events: List[Event],
+    coalescer: Coalescer,
+) -> List[Call]:
+    # batch handlers get every event of their type at once, the others one by one
+    calls: List[Call] = []
+    for event_type, group in _group_by_type(events).items():
+        for handler in handlers.get(event_type, []):
+            kept = coalescer.coalesce(handler, group)
+            if not kept:
+                continue
+            if getattr(handler, "accepts_batches", False):
+                calls.append((handler, kept))
+            else:
+                calls.extend((handler, event) for event in kept)
+    return calls
+
+
+def _run(calls: List[Call]) -> List[Call]:
+    failed: List[Call] = []
+    for handler, arg in calls:
+        try:
+            handler(arg)
+        except Exception:
+            logger.exception(f"Handler {handler.__name__} failed on {arg}")
+            failed.append((handler, arg))
+    return failed
+
+
+class HandlerPool:
+    """
+    Runs handlers on a pool of worker threads, at most workers of them at a
+    time. A handler still running after timeout seconds is given up on and
+    counted as failed, its worker is only free again once it returns.
+    """
+
+    def __init__(
+        self,
+        workers: int = global_settings.MESSAGE_BUS_WORKERS,
+        timeout: float = global_settings.MESSAGE_BUS_HANDLER_TIMEOUT,
+    ) -> None:
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers)
+        # threads are only started on the first calls
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="message-bus-handler"
+        )
+        self._stats_lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.timed_out = 0
+
+    def _count(self, counter: str) -> None:
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def run(self, calls: List[Call]) -> List[Call]:
+        """
+        Runs the calls and waits for them, returns those that failed or
+        timed out
+        """
+        failed: List[Call] = []
+        running = []
+        for handler, arg in calls:
+            # waits for a free worker, workers held by handlers that timed
+            # out earlier may never free up
+            if not self._slots.acquire(timeout=self.timeout):
+                self._count("timed_out")
+                logger.error(f"No free worker to run {handler.__name__} on {arg}")
+                failed.append((handler, arg))
+                continue
+            future = self._executor.submit(handler, arg)
+            future.add_done_callback(lambda _: self._slots.release())
+            running.append((handler, arg, future, time.monotonic() + self.timeout))
+
+        for handler, arg, future, deadline in running:
+            try:
+                future.result(timeout=max(0, deadline - time.monotonic()))
+                self._count("processed")
+            except FutureTimeoutError:
+                self._count("timed_out")
+                logger.error(f"Handler {handler.__name__} timed out on {arg}")
+                failed.append((handler, arg))
+            except Exception:
+                self._count("failed")
+                logger.exception(f"Handler {handler.__name__} failed on {arg}")
+                failed.append((handler, arg))
+        return failed
+
+    def stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            return dict(
+                workers=self.workers,
+                processed=self.processed,
+                failed=self.failed,
+                timed_out=self.timed_out,
+            )
+
+
+def handle_events(
+    events: List[Event],
+    handlers: Dict[Type[Event], List[Callable]] = HANDLERS,
+    coalescer: Coalescer = coalescer,
+    pool: HandlerPool | None = None,
+) -> List[Event]:
+    """
+    Hands the events to their handlers, on the pool when one is given and
+    in the calling thread otherwise. Returns the events a handler failed on,
+    to retry: the handlers that did not fail drop them as duplicates within
+    the coalescing window of their type
+    """
+    calls = _calls(handlers, events, coalescer)
+    failed_calls = pool.run(calls) if pool is not None else _run(calls)
+
+    failed: Dict[int, Event] = {}
+    for handler, arg in failed_calls:
+        failed_events = arg if isinstance(arg, list) else [arg]
+        coalescer.release(handler, failed_events)
+        failed.update((id(event), event) for event in failed_events)
+    return list(failed.values())
+
+
+def handle_event(event: Event) -> List[Event]:
+    return handle_events([event])
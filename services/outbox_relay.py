@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+from functools import partial
+from typing import Callable, Dict, List
+
+from sqlalchemy.orm import sessionmaker
+
+from domain.events import Event
+from infrastructure import AbstractOutbox, SqlAlchemyOutbox
+from infrastructure.database import get_session_factory
+from services import message_bus
+from settings import global_settings
+
+logger = logging.getLogger(__name__)
+
+
+def relay_events(
+    outbox: AbstractOutbox,
+    handle: Callable[[List[Event]], List[Event]],
+    batch_size: int = global_settings.OUTBOX_BATCH_SIZE,
+    max_attempts: int = global_settings.OUTBOX_MAX_ATTEMPTS,
+) -> int:
+    """
+    Hands a batch of pending events to handle, returns how many were claimed.
+    handle returns the events it failed on, those are retried on a later
+    batch until they failed max_attempts times, the others are removed from
+    the outbox
+    """
+    claimed = outbox.claim(limit=batch_size, max_attempts=max_attempts)
+    if not claimed:
+        return 0
+    try:
+        failed = {id(event) for event in handle([event for _, event in claimed])}
+    except Exception:
+        logger.exception("Failed to relay a batch of events")
+        failed = {id(event) for _, event in claimed}
+
+    outbox.mark_processed(
+        [outbox_id for outbox_id, event in claimed if id(event) not in failed]
+    )
+    outbox.mark_failed(
+        [outbox_id for outbox_id, event in claimed if id(event) in failed]
+    )
+    return len(claimed)
+
+
+def outbox_stats(
+    session_factory: sessionmaker | None = None,
+    max_attempts: int = global_settings.OUTBOX_MAX_ATTEMPTS,
+) -> Dict[str, float]:
+    """
+    How many events wait in the outbox and for how long, see
+    AbstractOutbox.stats
+    """
+    session_factory = session_factory or get_session_factory()
+    with session_factory() as session:
+        return SqlAlchemyOutbox(session=session).stats(max_attempts=max_attempts)
+
+
+class OutboxRelay:
+    """
+    Drains the outbox table into the message bus handlers. Events are
+    delivered at least once: a relay dying halfway through a batch rolls
+    back and the whole batch is handled again.
+    Any number of relays can run side by side, each claims different rows.
+    The handlers run on a HandlerPool: at most workers of them at once, each
+    given up on after handler_timeout seconds, which bounds how long the
+    claimed rows stay locked.
+    """
+
+    def __init__(
+        self,
+        session_factory: sessionmaker | None = None,
+        handle: Callable[[List[Event]], List[Event]] | None = None,
+        batch_size: int = global_settings.OUTBOX_BATCH_SIZE,
+        max_attempts: int = global_settings.OUTBOX_MAX_ATTEMPTS,
+        poll_interval: float = global_settings.OUTBOX_POLL_INTERVAL,
+        workers: int = global_settings.MESSAGE_BUS_WORKERS,
+        handler_timeout: float = global_settings.MESSAGE_BUS_HANDLER_TIMEOUT,
+        stats_interval: float = global_settings.OUTBOX_STATS_INTERVAL,
+    ) -> None:
+        self.session_factory = session_factory
+        self.pool = message_bus.HandlerPool(workers=workers, timeout=handler_timeout)
+        self.handle = handle or partial(message_bus.handle_events, pool=self.pool)
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.stats_interval = stats_interval
+
+    def relay_once(self) -> int:
+        session_factory = self.session_factory or get_session_factory()
+        with session_factory() as session:
+            claimed = relay_events(
+                SqlAlchemyOutbox(session=session),
+                self.handle,
+                batch_size=self.batch_size,
+                max_attempts=self.max_attempts,
+            )
+            session.commit()
+        return claimed
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return dict(
+            outbox=outbox_stats(self.session_factory, self.max_attempts),
+            handlers=self.pool.stats(),
+        )
+
+    def run(self, stop: threading.Event | None = None) -> None:
+        stop = stop or threading.Event()
+        logged_at = time.monotonic()
+        while not stop.is_set():
+            try:
+                claimed = self.relay_once()
+                if time.monotonic() - logged_at >= self.stats_interval:
+                    logger.info(f"Outbox relay stats: {self.stats()}")
+                    logged_at = time.monotonic()
+            except Exception:
+                logger.exception("Outbox relay failed, retrying")
+                claimed = 0
+            # a full batch means there are probably more events waiting
+            if claimed < self.batch_size:
+                stop.wait(self.poll_interval)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    OutboxRelay().run()
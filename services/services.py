@@ -1,9 +1,13 @@
+from collections import defaultdict
+from dataclasses import dataclass
 from datetime import date
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 from domain.aggregates import Product
+from domain.events import OutOfStockEvent
 from domain.models import (
     Batch,
+    InsufficientStocksException,
     Orderline,
 )
 from domain.models import (
@@ -12,7 +16,13 @@ from domain.models import (
 from domain.models import (
     deallocate as model_deallocate,
 )
-from services import AbstractUnitOfWork, BatchUnitOfWork, ProductUnitOfWork
+from infrastructure import LoadStrategy
+from services import (
+    AbstractUnitOfWork,
+    BatchUnitOfWork,
+    ConcurrencyError,
+    ProductUnitOfWork,
+)
 
 # Seems like this module sits between the Application (API) Layer and the Domain Layer
 # This is used by the application (API) layer to perform domain verbs/actions
@@ -29,14 +39,16 @@ def add_batch(
     Adds in a new batch to a Product
     """
     with uow:
-        product = uow.repository.get(reference)
+        # adding a batch never touches the allocations
+        product = uow.repository.get(reference, strategy=LoadStrategy.RAISE)
         if product is None:
             # Product does not exist, create new product with zero batches
             product = Product(sku=sku, batches=[])
             # persist new product to database
             uow.repository.add(product)
 
-        product.batches.append(Batch(reference, sku, quantity, eta))
+        product.add_batch(Batch(reference, sku, quantity, eta))
+        uow.read_model.adjust_available_quantity(sku, quantity)
         uow.commit()
 
 
@@ -53,24 +65,167 @@ def allocate(
     line = Orderline(order_id, sku, quantity)
 
     with uow:
-        batch = uow.repository.list()
+        version = uow.repository.get_product_version(line.sku)
+        batch = uow.repository.list_for_sku(line.sku)
 
         if not is_valid_sku(line.sku, batch):
             raise InvalidSkuError(f"Invalid sku: {line.sku}")
 
-        allocation = model_allocate(order_line=line, batches=batch)
+        try:
+            allocation, allocated = _allocate_and_update_read_model(line, batch, uow)
+        except InsufficientStocksException:
+            # nothing was allocated, but the event is a business fact that
+            # the notification handlers need, so it is committed regardless
+            uow.outbox.add(OutOfStockEvent(sku=line.sku))
+            uow.commit()
+            raise
+        if allocated:
+            # re-allocating a line that already is changes nothing
+            _bump_product_version(line.sku, version, uow)
         uow.commit()  # commit refers to the abstract uow commit, not from a db connector
 
         return allocation
 
 
+@dataclass
+class AllocationResult:
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str | None = None
+    error: str | None = None
+
+
+def allocate_many(
+    lines: List[Tuple[str, str, int]],
+    uow: AbstractUnitOfWork,
+) -> List[AllocationResult]:
+    """
+    Allocates many (orderid, sku, qty) lines in a single unit of work.
+    The batches of each sku are loaded once, and a failing line does not
+    prevent the others from being allocated: invalid lines, lines repeating
+    the orderid of a previous one or of an existing order line and lines out
+    of stock get an error.
+    Results are returned in the same order as the given lines
+    """
+    results = [
+        AllocationResult(orderid=orderid, sku=sku, qty=qty)
+        for orderid, sku, qty in lines
+    ]
+    results_by_sku: Dict[str, List[AllocationResult]] = defaultdict(list)
+    orderids = set()
+    for result in results:
+        result.error = _line_error(result, orderids)
+        if result.error is None:
+            orderids.add(result.orderid)
+            results_by_sku[result.sku].append(result)
+
+    with uow:
+        # order lines are unique by orderid, a line of an order that already
+        # has one in the database cannot be added
+        existing_orderids = uow.repository.existing_orderids(sorted(orderids))
+
+        # the products are locked by bump_product_version in the same order
+        # by every transaction, so that they cannot deadlock
+        for sku, sku_results in sorted(results_by_sku.items()):
+            version = uow.repository.get_product_version(sku)
+            batches = uow.repository.list_for_sku(sku)
+
+            if not is_valid_sku(sku, batches):
+                for result in sku_results:
+                    result.error = f"Invalid sku: {sku}"
+                continue
+
+            out_of_stock, allocated = False, False
+            for result in sku_results:
+                line = Orderline(result.orderid, result.sku, result.qty)
+                if result.orderid in existing_orderids and not any(
+                    batch.contains(line) for batch in batches
+                ):
+                    # unless it is this very line, allocated already
+                    result.error = f"Duplicate orderid: {result.orderid}"
+                    continue
+                try:
+                    allocation, line_allocated = _allocate_and_update_read_model(
+                        line, batches, uow
+                    )
+                    result.batchref = allocation.reference
+                    allocated = allocated or line_allocated
+                except InsufficientStocksException as e:
+                    result.error = str(e)
+                    out_of_stock = True
+
+            if out_of_stock:
+                uow.outbox.add(OutOfStockEvent(sku=sku))
+            if allocated:
+                _bump_product_version(sku, version, uow)
+
+        uow.commit()
+
+    return results
+
+
+def _bump_product_version(sku: str, version: int | None, uow: AbstractUnitOfWork):
+    """
+    Increments the version of the product of the batches changed by the unit
+    of work, version being the one read before loading them. Raises a
+    ConcurrencyError, that BaseUnitOfWork.run retries, when another
+    transaction changed the product in the meantime
+    """
+    if version is None or not uow.repository.bump_product_version(sku, version):
+        raise ConcurrencyError(
+            f"Product {sku} was modified by another transaction, retry the operation"
+        )
+
+
+def _line_error(result: AllocationResult, orderids: set) -> str | None:
+    if not isinstance(result.orderid, str) or not isinstance(result.sku, str):
+        return "orderid and sku must be strings"
+    # bool is an int too
+    valid_qty = isinstance(result.qty, int) and not isinstance(result.qty, bool)
+    if not valid_qty or result.qty <= 0:
+        return f"Invalid quantity: {result.qty!r}"
+    if result.orderid in orderids:
+        # order lines are unique by orderid
+        return f"Duplicate orderid: {result.orderid}"
+    return None
+
+
+def _allocate_and_update_read_model(
+    line: Orderline, batches: List[Batch], uow: AbstractUnitOfWork
+) -> Tuple[Batch, bool]:
+    """
+    Returns the batch of the line, and whether it was allocated by this call
+    rather than already allocated
+    """
+    already_allocated = any(batch.contains(line) for batch in batches)
+    allocation = model_allocate(order_line=line, batches=batches)
+    if not already_allocated:
+        uow.read_model.add_allocation(
+            line.orderid, line.sku, line.qty, allocation.reference
+        )
+        uow.read_model.adjust_available_quantity(line.sku, -line.qty)
+    return allocation, not already_allocated
+
+
 def deallocate(orderid: str, sku: str, qty: int, uow: AbstractUnitOfWork):
     line = Orderline(orderid=orderid, sku=sku, qty=qty)
     with uow:
-        batch = uow.repository.list()
-        if not is_valid_sku(line.sku, batch):
+        version = uow.repository.get_product_version(line.sku)
+        # only the batch holding the line is loaded, found through the indexed
+        # allocations, the others are loaded to tell why there is none
+        allocated_batch = uow.repository.get_allocated(line)
+        batches = (
+            [allocated_batch]
+            if allocated_batch is not None
+            else uow.repository.list_for_sku(line.sku)
+        )
+        if not is_valid_sku(line.sku, batches):
             raise InvalidSkuError(f"Invalid sku: {line.sku}")
-        deallocated_batch = model_deallocate(order_line=line, batches=batch)
+        deallocated_batch = model_deallocate(order_line=line, batches=batches)
+        uow.read_model.remove_allocation(line.orderid)
+        uow.read_model.adjust_available_quantity(line.sku, line.qty)
+        _bump_product_version(line.sku, version, uow)
         uow.commit()
         return deallocated_batch
 
@@ -78,7 +233,12 @@ def deallocate(orderid: str, sku: str, qty: int, uow: AbstractUnitOfWork):
 def restock(reference: str, sku: str, qty: int, eta: date | None, uow: BatchUnitOfWork):
     batch = Batch(reference=reference, sku=sku, qty=qty, eta=eta)
     with uow:
-        uow.repository.add(batch=batch)
+        version = uow.repository.get_product_version(sku)
+        uow.repository.add(batch)
+        uow.read_model.adjust_available_quantity(sku, qty)
+        if version is not None:
+            # otherwise there is no product, and the batch cannot be added
+            _bump_product_version(sku, version, uow)
         uow.commit()
         return batch
 
@@ -97,13 +257,15 @@ def change_batch_quantity(
 
         batch = batch[0]
 
-        batch._purchased_quantity = new_quantity
-
-        # pop any lines until available quantity is positive
-        deallocated_lines = []
-        while batch.available_quantity < 0:
-            deallocated_lines.append(batch.deallocate_one())
+        available_quantity = batch.available_quantity
+        # through the aggregate, which keeps its allocations index up to date
+        deallocated_lines = product.change_batch_quantity(batch_ref, new_quantity)
 
+        for line in deallocated_lines:
+            uow.read_model.remove_allocation(line.orderid)
+        uow.read_model.adjust_available_quantity(
+            sku, batch.available_quantity - available_quantity
+        )
         uow.commit()
 
     return deallocated_lines
@@ -1,35 +1,104 @@
+import logging
+import random
+import threading
+import time
 from abc import ABC, abstractmethod
 from copy import deepcopy
-from typing import Generic, List, Protocol, Type, TypeVar, Union
+from dataclasses import dataclass
+from typing import Callable, Generic, Iterator, List, Protocol, Type, TypeVar, Union
 
-from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
 
 from domain.aggregates import AbstractAggregate, Product
+from domain.events import Event
 from domain.models import Batch, Entity
 from infrastructure import (
+    AbstractOutbox,
+    AbstractReadModel,
     AbstractRepository,
     BatchFakeRepository,
     BatchRepository,
+    CachedProductRepository,
+    FakeOutbox,
+    FakeReadModel,
     FakeRepository,
     ProductFakeRepository,
     ProductRepository,
+    SqlAlchemyOutbox,
+    SqlAlchemyReadModel,
     SqlAlchemyRepository,
 )
+from infrastructure.cache import AggregateCache, product_cache
+from infrastructure.database import get_read_only_session_factory, get_session_factory
 from settings import global_settings
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(url=global_settings.DB_DSN, isolation_level="REPEATABLE READ"),
-    expire_on_commit=False,
-    autocommit=False,
-)
+logger = logging.getLogger(__name__)
+
+
+class ConcurrencyError(Exception):
+    ...
+
+
+class ReadOnlyUnitOfWorkError(Exception):
+    ...
+
+
+# serialization_failure and deadlock_detected
+RETRYABLE_PGCODES = {"40001", "40P01"}
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, ConcurrencyError):
+        return True
+    if isinstance(error, DBAPIError):
+        return getattr(error.orig, "pgcode", None) in RETRYABLE_PGCODES
+    return False
+
+
+@dataclass
+class RetryPolicy:
+    attempts: int = global_settings.DB_RETRY_ATTEMPTS
+    backoff: float = global_settings.DB_RETRY_BACKOFF
+    max_backoff: float = global_settings.DB_RETRY_MAX_BACKOFF
+
+    def delay(self, attempt: int) -> float:
+        # exponential backoff with full jitter so contending workers spread out
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+
+class RetryStats:
+    """
+    Process wide counters of the retries done by the units of work
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.failures = 0
+
+    def record_retry(self) -> None:
+        with self._lock:
+            self.retries += 1
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+
+
+retry_stats = RetryStats()
+
 
 RepositoryT = TypeVar("RepositoryT", bound=AbstractRepository)
 SqlAlchemyRepositoryT = TypeVar("SqlAlchemyRepositoryT", bound=SqlAlchemyRepository)
+T = TypeVar("T")
 
 
 class AbstractUnitOfWork(ABC, Generic[RepositoryT]):
     repository: RepositoryT
+    read_model: AbstractReadModel
+    outbox: AbstractOutbox
 
     @abstractmethod
     def rollback(self):
@@ -47,6 +116,19 @@ class AbstractUnitOfWork(ABC, Generic[RepositoryT]):
     def __exit__(self, *args):
         raise NotImplementedError
 
+    def collect_new_events(self) -> Iterator[Event]:
+        seen = {id(aggregate): aggregate for aggregate in self.repository.seen}
+        for aggregate in seen.values():
+            events = getattr(aggregate, "events", None)
+            while events:
+                yield events.pop(0)
+
+    def _add_events_to_outbox(self) -> None:
+        # called before committing, the events are stored in the same
+        # transaction as the changes that raised them
+        for event in self.collect_new_events():
+            self.outbox.add(event)
+
 
 class BaseUnitOfWork(AbstractUnitOfWork, ABC, Generic[SqlAlchemyRepositoryT]):
     # _repository resides in the Base class because it is part of how to implement
@@ -57,19 +139,54 @@ class BaseUnitOfWork(AbstractUnitOfWork, ABC, Generic[SqlAlchemyRepositoryT]):
     def _repository(self) -> Type[SqlAlchemyRepositoryT]:
         ...
 
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY) -> None:
+    def __init__(
+        self,
+        session_factory: sessionmaker | None = None,
+        retry_policy: RetryPolicy | None = None,
+    ) -> None:
+        # None means the process wide session factory, resolved on __enter__
+        # so that constructing a unit of work never creates an engine
         self.session_factory = session_factory
+        self.retry_policy = retry_policy or RetryPolicy()
+
+    def run(self, service: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Runs a service function with this unit of work, re-running it when it
+        fails because of a concurrent write to the same data
+        """
+        attempt = 1
+        while True:
+            try:
+                return service(*args, uow=self, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                if attempt >= self.retry_policy.attempts:
+                    retry_stats.record_failure()
+                    logger.warning(
+                        f"Giving up {service.__name__} after {attempt} attempts: {e}"
+                    )
+                    raise
+                retry_stats.record_retry()
+                time.sleep(self.retry_policy.delay(attempt))
+                attempt += 1
 
     def __enter__(self):
         """
         This UoW can be used as a context manager
         """
-        self.session = self.session_factory()
+        session_factory = self.session_factory or self._default_session_factory()
+        self.session = session_factory()
         self.repository = self._repository(session=self.session)
+        self.read_model = SqlAlchemyReadModel(session=self.session)
+        self.outbox = SqlAlchemyOutbox(session=self.session)
 
     def __exit__(self, *args):
         self.session.close()
 
+    def _default_session_factory(self) -> sessionmaker:
+        return get_session_factory()
+
     def rollback(self):
         self.session.rollback()
 
@@ -77,7 +194,14 @@ class BaseUnitOfWork(AbstractUnitOfWork, ABC, Generic[SqlAlchemyRepositoryT]):
         return self.commit()
 
     def commit(self):
-        self.session.commit()
+        self._add_events_to_outbox()
+        try:
+            self.session.commit()
+        except StaleDataError as e:
+            self.session.rollback()
+            raise ConcurrencyError(
+                "Aggregate was modified by another transaction, retry the operation"
+            ) from e
 
 
 class SqlAlchemyUnitOfWork(BaseUnitOfWork[SqlAlchemyRepository]):
@@ -92,10 +216,59 @@ class SqlAlchemyUnitOfWork(BaseUnitOfWork[SqlAlchemyRepository]):
 
 
 class ProductUnitOfWork(BaseUnitOfWork[ProductRepository]):
+    def __init__(
+        self,
+        session_factory: sessionmaker | None = None,
+        retry_policy: RetryPolicy | None = None,
+        cache: AggregateCache[Product] | None = None,
+    ) -> None:
+        """
+        Pass a cache to reuse the products loaded by previous units of work of
+        this process, it is infrastructure.cache.product_cache by default when
+        PRODUCT_CACHE_ENABLED is set
+        """
+        super().__init__(session_factory=session_factory, retry_policy=retry_policy)
+        self.cache = cache if cache is not None else self._default_cache()
+
+    def _default_cache(self) -> AggregateCache[Product] | None:
+        return product_cache if global_settings.PRODUCT_CACHE_ENABLED else None
+
     @property
     def _repository(self) -> Type[ProductRepository]:
         return ProductRepository
 
+    def __enter__(self):
+        super().__enter__()
+        self._committed = False
+        if self.cache is not None:
+            self.repository = CachedProductRepository(
+                session=self.session, cache=self.cache
+            )
+
+    def __exit__(self, *args):
+        # the products are left with uncommitted changes unless the session
+        # is clean since the last commit
+        clean = not (self.session.new or self.session.dirty or self.session.deleted)
+        super().__exit__(*args)
+        if (
+            isinstance(self.repository, CachedProductRepository)
+            and self._committed
+            and clean
+        ):
+            # only shared once detached from the closed session, so that no
+            # other unit of work adds them to its own session before that
+            self.repository.release()
+
+    def rollback(self):
+        self._committed = False
+        super().rollback()
+
+    def commit(self):
+        # a failed commit rolls back, expiring the products
+        self._committed = False
+        super().commit()
+        self._committed = True
+
     def get(self, sku: str) -> Product:
         try:
             product = self.repository.get(sku=sku)
@@ -105,6 +278,47 @@ class ProductUnitOfWork(BaseUnitOfWork[ProductRepository]):
             raise e
 
 
+class ReadOnlyProductUnitOfWork(ProductUnitOfWork):
+    """
+    Product queries against the read replica, this unit of work never commits
+    """
+
+    def __init__(
+        self,
+        session_factory: sessionmaker | None = None,
+        retry_policy: RetryPolicy | None = None,
+        cache: AggregateCache[Product] | None = None,
+        snapshot: bool = False,
+    ) -> None:
+        """
+        With snapshot, all the queries see the database as it was on the
+        first one (REPEATABLE READ) instead of each seeing the latest commits
+        """
+        super().__init__(
+            session_factory=session_factory, retry_policy=retry_policy, cache=cache
+        )
+        self.snapshot = snapshot
+
+    def __enter__(self):
+        super().__enter__()
+        if self.snapshot:
+            # has to be set before the transaction runs its first query
+            self.session.connection(
+                execution_options={"isolation_level": "REPEATABLE READ"}
+            )
+
+    def _default_session_factory(self) -> sessionmaker:
+        return get_read_only_session_factory()
+
+    def _default_cache(self) -> AggregateCache[Product] | None:
+        # products are taken out of the cache while in use and only put back
+        # on commit, they would never be returned
+        return None
+
+    def commit(self):
+        raise ReadOnlyUnitOfWorkError("Read only unit of work cannot commit")
+
+
 class BatchUnitOfWork(BaseUnitOfWork[BatchRepository]):
     @property
     def _repository(self) -> Type[BatchRepository]:
@@ -125,6 +339,8 @@ class FakeUnitOfWork(
 
     def __init__(self, data: List[EntityOrAggregateT] | None = []) -> None:
         self.repository = self._repository(data)
+        self.read_model = FakeReadModel()
+        self.outbox = FakeOutbox()
         super().__init__()
 
     def _commit(self):
@@ -140,6 +356,7 @@ class FakeUnitOfWork(
         ...
 
     def commit(self):
+        self._add_events_to_outbox()
         self._commit()
 
 
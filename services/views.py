@@ -0,0 +1,21 @@
+from typing import Dict
+
+from services import AbstractUnitOfWork
+
+# Queries answered from the read model (CQRS), they never load aggregates
+
+
+def allocation(orderid: str, uow: AbstractUnitOfWork) -> Dict | None:
+    """
+    Returns where the order is allocated, None if it is not allocated
+    """
+    with uow:
+        return uow.read_model.get_allocation(orderid)
+
+
+def availability(sku: str, uow: AbstractUnitOfWork) -> int | None:
+    """
+    Returns the quantity of the sku still available, None for unknown skus
+    """
+    with uow:
+        return uow.read_model.get_available_quantity(sku)
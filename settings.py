@@ -15,6 +15,48 @@ class Settings(BaseSettings):
     # DB_DSN_QUERY: str = Field("sslmode=requre", env=[""])
     # DB_DSB: stricturl(tld_required=False, allowed_schemes={"postgresql", "postgresql+asyncpg", "postgresql+psycopg", "postgresql+psycopg2"}) = Field(None, env=[""])
     DB_DSN: str = ""
+    # read only queries go to this replica, the primary DB_DSN when empty
+    DB_REPLICA_DSN: str = ""
+    # Connection pool, per process
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30
+    # seconds after which a pooled connection is replaced, -1 to never recycle
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    # milliseconds, 0 to disable
+    DB_STATEMENT_TIMEOUT: int = 0
+    # Per process cache of the Product aggregates loaded by the write paths
+    # (ProductUnitOfWork), a unit of work can also be given its own cache
+    PRODUCT_CACHE_ENABLED: bool = False
+    PRODUCT_CACHE_SIZE: int = 128
+    # seconds
+    PRODUCT_CACHE_TTL: float = 60
+    # Message bus, seconds during which further OutOfStockEvents of a sku
+    # are dropped
+    OUT_OF_STOCK_NOTIFICATION_WINDOW: float = 300
+    # handlers run at once by an outbox relay
+    MESSAGE_BUS_WORKERS: int = 4
+    # seconds after which a handler is given up on and its events retried
+    MESSAGE_BUS_HANDLER_TIMEOUT: float = 5
+    # Relay of the events stored in the outbox table
+    OUTBOX_BATCH_SIZE: int = 100
+    # events failing this many times are left in the outbox and not retried
+    OUTBOX_MAX_ATTEMPTS: int = 5
+    # seconds the relay waits before polling again when the outbox is empty
+    OUTBOX_POLL_INTERVAL: float = 1
+    # seconds between two logs of the relay metrics
+    OUTBOX_STATS_INTERVAL: float = 60
+    # GET /products
+    PRODUCTS_MAX_PAGE_SIZE: int = 1000
+    # products fetched at a time when streaming the whole catalogue
+    PRODUCTS_STREAM_CHUNK_SIZE: int = 100
+    # seconds the responses can be served from a cache without revalidation
+    PRODUCTS_CACHE_MAX_AGE: int = 5
+    # Retries of units of work failing on concurrent writes
+    DB_RETRY_ATTEMPTS: int = 3
+    DB_RETRY_BACKOFF: float = 0.01
+    DB_RETRY_MAX_BACKOFF: float = 0.5
 
     @validator("DB_DSN", pre=True, always=True)
     def make_dsn(cls, v, values: Dict[str, str | int], **kwargs):
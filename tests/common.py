@@ -113,6 +113,9 @@ def delete_all_data(session: Session):
     result = session.execute(
         text(
             """
+            DELETE FROM public.outbox;
+            DELETE FROM public.allocations_view;
+            DELETE FROM public.availability_view;
             DELETE FROM public.allocations;
             DELETE FROM public.order_lines;
             DELETE FROM public.batch;
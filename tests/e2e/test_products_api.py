@@ -0,0 +1,119 @@
+import json
+
+import pytest
+from sqlalchemy.orm import Session
+
+from flask_api.app import app
+from services.services import allocate
+from services.unit_of_work import BatchUnitOfWork
+from settings import global_settings
+from tests.common import (
+    delete_all_data,
+    insert_batch,
+    insert_product,
+    random_batch_ref,
+    random_order_id,
+    random_sku,
+)
+
+
+@pytest.fixture(scope="function")
+def products(session: Session):
+    # skus sharing a prefix follow each other once ordered
+    prefix = random_sku()
+    skus = [f"{prefix}-{i}" for i in range(3)]
+    for sku in skus:
+        insert_product(session=session, sku=sku)
+        insert_batch(session=session, ref=random_batch_ref(), sku=sku, qty=10)
+
+    yield prefix, skus
+
+    delete_all_data(session=session)
+
+
+@pytest.fixture(scope="function")
+def client():
+    return app.test_client()
+
+
+def test_product_is_not_modified_until_its_version_changes(client, products):
+    _, [sku, *_] = products
+
+    response = client.get(f"/products/{sku}")
+    assert response.status_code == 200
+    assert response.get_json()["sku"] == sku
+    assert (
+        response.headers["Cache-Control"]
+        == f"public, max-age={global_settings.PRODUCTS_CACHE_MAX_AGE}"
+    )
+    etag = response.headers["ETag"]
+
+    response = client.get(f"/products/{sku}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    allocate(random_order_id(), sku, 1, uow=BatchUnitOfWork())
+
+    response = client.get(f"/products/{sku}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_unknown_product_is_not_found(client):
+    assert client.get(f"/products/{random_sku()}").status_code == 404
+
+
+def test_products_page_is_not_modified_until_a_version_changes(client, products):
+    prefix, skus = products
+    url = f"/products?after={prefix}&limit=2&exclude=batches._allocations"
+
+    response = client.get(url)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert [product["sku"] for product in body["products"]] == skus[:2]
+    assert body["next"] == skus[1]
+    assert "_allocations" not in body["products"][0]["batches"][0]
+    etag = response.headers["ETag"]
+
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    # a different page or selection of fields has its own ETag
+    response = client.get(f"/products?after={prefix}&limit=2")
+    assert response.headers["ETag"] != etag
+
+    # outside of the page
+    allocate(random_order_id(), skus[2], 1, uow=BatchUnitOfWork())
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    allocate(random_order_id(), skus[0], 1, uow=BatchUnitOfWork())
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_products_are_streamed_without_limit(client, products):
+    prefix, skus = products
+
+    response = client.get(f"/products?after={prefix}&exclude=batches")
+    assert response.status_code == 200
+    assert response.is_streamed
+    etag = response.headers["ETag"]
+
+    streamed = json.loads(response.get_data())["products"]
+    assert streamed[: len(skus)] == [dict(sku=sku, version=1) for sku in skus]
+
+    response = client.get(
+        f"/products?after={prefix}&exclude=batches", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+
+def test_streamed_products_match_their_etag(client, products):
+    prefix, [sku, *_] = products
+    url = f"/products?after={prefix}&exclude=batches"
+    etag = client.get(url).headers["ETag"]
+
+    response = client.get(url)
+    # changed once the ETag was computed but before the products are streamed
+    allocate(random_order_id(), sku, 1, uow=BatchUnitOfWork())
+
+    assert response.headers["ETag"] == etag
+    assert json.loads(response.get_data())["products"][0] == dict(sku=sku, version=1)
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 200
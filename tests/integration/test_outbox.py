@@ -0,0 +1,113 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from domain.events import OutOfStockEvent
+from domain.models import InsufficientStocksException
+from flask_api.app import app
+from infrastructure.outbox import SqlAlchemyOutbox
+from services.outbox_relay import OutboxRelay, outbox_stats
+from services.services import allocate
+from services.unit_of_work import BatchUnitOfWork
+from tests.common import (
+    delete_all_data,
+    insert_batch,
+    insert_product,
+    random_batch_ref,
+    random_order_id,
+    random_sku,
+)
+
+
+@pytest.fixture(scope="function")
+def session_factory(engine: Engine, session: Session):
+    delete_all_data(session=session)
+
+    yield sessionmaker(bind=engine)
+
+    delete_all_data(session=session)
+
+
+def add_events(session_factory: sessionmaker, skus) -> None:
+    with session_factory() as session:
+        outbox = SqlAlchemyOutbox(session=session)
+        for sku in skus:
+            outbox.add(OutOfStockEvent(sku=sku))
+        session.commit()
+
+
+def test_concurrent_claims_skip_the_locked_events(session_factory: sessionmaker):
+    add_events(session_factory, ["SMALL-FORK", "SMALL-SPOON", "SMALL-KNIFE"])
+
+    with session_factory() as first, session_factory() as second:
+        first_claim = SqlAlchemyOutbox(session=first).claim(limit=2, max_attempts=5)
+        second_claim = SqlAlchemyOutbox(session=second).claim(limit=10, max_attempts=5)
+
+    assert [event.sku for _, event in first_claim] == ["SMALL-FORK", "SMALL-SPOON"]
+    assert [event.sku for _, event in second_claim] == ["SMALL-KNIFE"]
+
+
+def test_processed_events_are_deleted_and_failed_ones_retried(
+    session_factory: sessionmaker,
+):
+    add_events(session_factory, ["SMALL-FORK", "SMALL-SPOON"])
+
+    with session_factory() as session:
+        outbox = SqlAlchemyOutbox(session=session)
+        [(fork_id, _), (spoon_id, _)] = outbox.claim(limit=10, max_attempts=2)
+        outbox.mark_processed([fork_id])
+        outbox.mark_failed([spoon_id])
+        session.commit()
+
+    with session_factory() as session:
+        outbox = SqlAlchemyOutbox(session=session)
+        assert outbox.claim(limit=10, max_attempts=2) == [
+            (spoon_id, OutOfStockEvent(sku="SMALL-SPOON"))
+        ]
+        outbox.mark_failed([spoon_id])
+        session.commit()
+
+    with session_factory() as session:
+        outbox = SqlAlchemyOutbox(session=session)
+        # failed max_attempts times, left in the outbox
+        assert outbox.claim(limit=10, max_attempts=2) == []
+        [[attempts]] = session.execute(text("SELECT attempts FROM outbox"))
+        assert attempts == 2
+        assert outbox.stats(max_attempts=2) == dict(pending=0, given_up=1, lag=0)
+        stats = outbox.stats(max_attempts=3)
+        assert (stats["pending"], stats["given_up"]) == (1, 0)
+        assert stats["lag"] > 0
+
+
+def test_out_of_stock_allocations_are_relayed(
+    session_factory: sessionmaker, session: Session
+):
+    sku = random_sku()
+    insert_product(session=session, sku=sku)
+    insert_batch(session=session, ref=random_batch_ref(), sku=sku, qty=10)
+
+    with pytest.raises(InsufficientStocksException):
+        allocate(random_order_id(), sku, 20, uow=BatchUnitOfWork())
+
+    handled = []
+
+    def handle(events):
+        handled.extend(events)
+        return []
+
+    relay = OutboxRelay(session_factory=session_factory, handle=handle)
+
+    assert outbox_stats(session_factory)["pending"] == 1
+    assert relay.relay_once() == 1
+    assert handled == [OutOfStockEvent(sku=sku)]
+    assert relay.relay_once() == 0
+
+
+def test_stats_report_the_outbox_depth(session_factory: sessionmaker):
+    add_events(session_factory, ["SMALL-FORK", "SMALL-SPOON"])
+
+    response = app.test_client().get("/stats")
+
+    assert response.status_code == 200
+    assert response.get_json()["outbox"]["pending"] == 2
@@ -0,0 +1,131 @@
+import importlib.util
+from pathlib import Path
+
+import pytest
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from flask_api.app import app
+from services.services import allocate, change_batch_quantity, deallocate, restock
+from services.unit_of_work import BatchUnitOfWork, ProductUnitOfWork
+from tests.common import (
+    delete_all_data,
+    insert_allocations,
+    insert_batch,
+    insert_order_lines,
+    insert_product,
+    random_batch_ref,
+    random_order_id,
+    random_sku,
+)
+
+READ_MODEL_MIGRATION = (
+    Path(__file__).parents[2]
+    / "alembic"
+    / "versions"
+    / "e5d0db36b666_add_read_model_views.py"
+)
+
+
+@pytest.fixture(scope="function")
+def sku(session: Session):
+    sku = random_sku()
+    insert_product(session=session, sku=sku)
+
+    yield sku
+
+    delete_all_data(session=session)
+
+
+@pytest.fixture(scope="function")
+def client():
+    return app.test_client()
+
+
+def get_availability(client, sku: str) -> int:
+    response = client.get(f"/products/{sku}/availability")
+    assert response.status_code == 200
+    return response.get_json()["available_quantity"]
+
+
+def test_read_model_follows_allocations_and_deallocations(sku, client):
+    batch_ref = random_batch_ref()
+    orderid = random_order_id()
+
+    restock(batch_ref, sku, 20, None, uow=BatchUnitOfWork())
+    assert get_availability(client, sku) == 20
+
+    allocate(orderid, sku, 5, uow=BatchUnitOfWork())
+    # allocating the same line again is a no-op
+    allocate(orderid, sku, 5, uow=BatchUnitOfWork())
+
+    response = client.get(f"/allocations/{orderid}")
+    assert response.status_code == 200
+    assert response.get_json() == dict(
+        orderid=orderid, sku=sku, qty=5, batchref=batch_ref
+    )
+    assert get_availability(client, sku) == 15
+
+    deallocate(orderid, sku, 5, uow=BatchUnitOfWork())
+
+    assert client.get(f"/allocations/{orderid}").status_code == 404
+    assert get_availability(client, sku) == 20
+
+
+def test_read_model_follows_batch_quantity_changes(sku, client):
+    batch_ref = random_batch_ref()
+    orderid = random_order_id()
+    restock(batch_ref, sku, 20, None, uow=BatchUnitOfWork())
+    allocate(orderid, sku, 10, uow=BatchUnitOfWork())
+    assert get_availability(client, sku) == 10
+
+    deallocated = change_batch_quantity(batch_ref, sku, 8, uow=ProductUnitOfWork())
+
+    assert [line.orderid for line in deallocated] == [orderid]
+    assert client.get(f"/allocations/{orderid}").status_code == 404
+    assert get_availability(client, sku) == 8
+
+
+def test_unknown_sku_has_no_availability(client):
+    assert client.get(f"/products/{random_sku()}/availability").status_code == 404
+
+
+def test_migration_backfills_the_read_model(sku, session: Session):
+    batch_ref, other_batch_ref = random_batch_ref(), random_batch_ref()
+    orderid = random_order_id()
+    insert_batch(session=session, ref=batch_ref, sku=sku, qty=10)
+    insert_batch(session=session, ref=other_batch_ref, sku=sku, qty=5)
+    insert_order_lines(session=session, orderid=orderid, sku=sku, qty=3)
+    insert_allocations(session=session, orderid=orderid, batch_ref=batch_ref)
+
+    spec = importlib.util.spec_from_file_location(
+        "add_read_model_views", READ_MODEL_MIGRATION
+    )
+    migration = importlib.util.module_from_spec(spec)  # type: ignore
+    spec.loader.exec_module(migration)  # type: ignore
+
+    # run in a transaction that is rolled back, leaving the tables as they were
+    connection = session.connection()
+    try:
+        connection.execute(text("DROP TABLE allocations_view, availability_view"))
+        with Operations.context(MigrationContext.configure(connection)):
+            migration.upgrade()
+
+        allocations = connection.execute(
+            text(
+                "SELECT orderid, sku, qty, batchref FROM allocations_view "
+                "WHERE sku = :sku"
+            ),
+            dict(sku=sku),
+        ).fetchall()
+        available_quantity = connection.execute(
+            text("SELECT available_quantity FROM availability_view WHERE sku = :sku"),
+            dict(sku=sku),
+        ).scalar()
+    finally:
+        session.rollback()
+
+    assert [tuple(row) for row in allocations] == [(orderid, sku, 3, batch_ref)]
+    assert available_quantity == 12
@@ -1,10 +1,23 @@
+from contextlib import contextmanager
+from itertools import islice
+from typing import Iterator, List
+
 import pytest
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm import Session
 from sqlalchemy.sql import text
 
 from domain.models import Batch, Orderline
-from infrastructure.repository import BatchRepository
+from infrastructure.repository import (
+    BatchRepository,
+    LoadStrategy,
+    ProductRepository,
+    _version_digest,
+)
 from tests.common import (
+    delete_all_data,
     insert_allocations,
     insert_batch,
     insert_order_lines,
@@ -84,3 +97,163 @@ def test_repository_can_save_a_batch(session: Session, prepare_test_data):
     ).all()
 
     assert rows == [(batch_ref, sku, 100, None)]
+
+
+def test_repository_finds_the_batch_a_line_is_allocated_to(
+    session: Session, prepare_test_data
+):
+    order, batch_one, batch_two, sku = prepare_test_data
+    repo = BatchRepository(session)
+
+    line = Orderline(order["orderid"], sku, order["ordered_qty"])
+    assert repo.get_allocated(line).reference == batch_one["batch_ref"]
+    # another quantity is another line
+    assert repo.get_allocated(Orderline(order["orderid"], sku, 1)) is None
+    session.rollback()
+
+
+def test_loaded_products_index_their_allocations(session: Session, prepare_test_data):
+    order, batch_one, batch_two, sku = prepare_test_data
+    repo = ProductRepository(session)
+
+    product = repo.get(sku)
+
+    assert product.allocated_batch(order["orderid"]).reference == batch_one["batch_ref"]
+    line = Orderline(order["orderid"], sku, order["ordered_qty"])
+    assert product.deallocate(line) == batch_one["batch_ref"]
+    assert product.allocated_batch(order["orderid"]) is None
+    session.rollback()
+
+
+@contextmanager
+def statements(engine: Engine) -> Iterator[List[str]]:
+    executed: List[str] = []
+
+    def record(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield executed
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+
+def test_joined_strategy_loads_the_product_in_a_single_query(
+    engine: Engine, prepare_test_data
+):
+    order, batch_one, batch_two, sku = prepare_test_data
+
+    with Session(bind=engine) as session, statements(engine) as executed:
+        product = ProductRepository(session).get(sku, strategy=LoadStrategy.JOINED)
+        allocations = [batch._allocations for batch in product.batches]
+
+    [query] = executed
+    assert "JOIN batch" in query and "JOIN order_lines" in query
+    assert sum(len(lines) for lines in allocations) == 1
+
+
+def test_selectin_strategy_loads_each_relationship_in_one_query(
+    engine: Engine, prepare_test_data
+):
+    order, batch_one, batch_two, sku = prepare_test_data
+
+    with Session(bind=engine) as session, statements(engine) as executed:
+        [product] = ProductRepository(session).list_for_sku(
+            sku, strategy=LoadStrategy.SELECTIN
+        )
+        allocations = [batch._allocations for batch in product.batches]
+
+    products_query, batches_query, allocations_query = executed
+    assert "JOIN" not in products_query
+    assert "IN (" in batches_query and "IN (" in allocations_query
+    assert sum(len(lines) for lines in allocations) == 1
+
+
+def test_raise_strategy_loads_all_but_the_allocations(
+    engine: Engine, prepare_test_data
+):
+    order, batch_one, batch_two, sku = prepare_test_data
+
+    with Session(bind=engine) as session, statements(engine) as executed:
+        product = ProductRepository(session).get(sku, strategy=LoadStrategy.RAISE)
+        batch = BatchRepository(session).get(
+            batch_one["batch_ref"], strategy=LoadStrategy.RAISE
+        )
+
+        assert len(product.batches) == 2
+        with pytest.raises(InvalidRequestError):
+            product.batches[0]._allocations
+        with pytest.raises(InvalidRequestError):
+            batch._allocations
+
+    assert not any("allocations" in statement for statement in executed)
+
+
+def test_none_strategy_loads_the_aggregate_alone(engine: Engine, prepare_test_data):
+    order, batch_one, batch_two, sku = prepare_test_data
+
+    with Session(bind=engine) as session, statements(engine) as executed:
+        product = ProductRepository(session).get(sku, strategy=LoadStrategy.NONE)
+
+        assert product.version == 1
+        with pytest.raises(InvalidRequestError):
+            product.batches
+
+    [query] = executed
+    assert "batch" not in query
+
+
+@pytest.fixture(scope="function")
+def products(session: Session):
+    # skus sharing a prefix follow each other once ordered
+    prefix = random_sku()
+    skus = [f"{prefix}-{i}" for i in range(5)]
+    for sku in skus:
+        insert_product(session=session, sku=sku)
+        insert_batch(session=session, ref=random_batch_ref(), sku=sku, qty=10)
+
+    yield prefix, skus
+
+    delete_all_data(session=session)
+
+
+def test_version_digest_is_computed_like_the_fake_repository(
+    session: Session, products
+):
+    prefix, skus = products
+    repo = ProductRepository(session)
+
+    assert repo.version_digest(after=prefix, limit=3) == _version_digest(
+        [f"{sku}:1" for sku in skus[:3]]
+    )
+    digest = repo.version_digest(after=prefix, limit=3)
+
+    batches = BatchRepository(session)
+    assert batches.bump_product_version(skus[1], version=1)
+    # the version it was read at is gone
+    assert not batches.bump_product_version(skus[1], version=1)
+    session.commit()
+
+    assert repo.version_digest(after=prefix, limit=3) != digest
+    assert repo.version_digest(after=skus[2], limit=3) == _version_digest(
+        [f"{sku}:1" for sku in skus[3:]]
+    )
+
+
+def test_stream_detaches_the_products_it_has_read(session: Session, products):
+    prefix, skus = products
+    repo = ProductRepository(session)
+
+    stream = repo.stream(after=prefix, chunk_size=2)
+    streamed = list(islice(stream, 3))
+    stream.close()
+
+    assert [product.sku for product in streamed] == skus[:3]
+    # the first chunk was let go of once the second one was fetched
+    assert inspect(streamed[0]).detached and inspect(streamed[1]).detached
+    assert not inspect(streamed[2]).detached
+    # loaded along with the products, readable once detached
+    assert [batch.available_quantity for batch in streamed[0].batches] == [10]
+    assert repo.seen == []
+    session.rollback()
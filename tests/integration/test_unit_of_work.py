@@ -3,13 +3,19 @@ import traceback
 from time import sleep
 
 import pytest
-from sqlalchemy import text
+from sqlalchemy import inspect, text
 from sqlalchemy.orm import Session
 
 from domain.aggregates import Product
-from domain.models import Orderline
-from services.services import change_batch_quantity
-from services.unit_of_work import BatchUnitOfWork, ProductUnitOfWork
+from domain.models import InsufficientStocksException, Orderline
+from services.services import allocate, allocate_many, change_batch_quantity, deallocate
+from services.unit_of_work import (
+    BatchUnitOfWork,
+    ConcurrencyError,
+    ProductUnitOfWork,
+)
+from infrastructure.cache import AggregateCache, product_cache
+from settings import global_settings
 from tests.common import (
     delete_all_data,
     get_allcated_batch_ref,
@@ -98,6 +104,51 @@ def test_change_product_batch_quantity(data_with_allocations, session: Session):
     assert qty == new_quantity
 
 
+def test_change_batch_quantity_reuses_cached_products(
+    test_data, monkeypatch, session: Session
+):
+    sku, batch_ref = test_data
+    monkeypatch.setattr(global_settings, "PRODUCT_CACHE_ENABLED", True)
+    hits = product_cache.hits
+
+    for new_quantity in (20, 30):
+        change_batch_quantity(
+            batch_ref=batch_ref,
+            sku=sku,
+            new_quantity=new_quantity,
+            uow=ProductUnitOfWork(),
+        )
+
+    assert product_cache.hits == hits + 1
+    [[qty]] = session.execute(
+        text("SELECT _purchased_quantity FROM public.batch WHERE reference = :ref"),
+        dict(ref=batch_ref),
+    )
+    assert qty == 30
+
+
+def test_products_are_cached_once_detached_and_committed(test_data):
+    sku, batch_ref = test_data
+    cache: AggregateCache = AggregateCache()
+
+    uow = ProductUnitOfWork(cache=cache)
+    with uow:
+        product = uow.get(sku=sku)
+        product.change_batch_quantity(batch_ref, 20)
+        uow.commit()
+        # still attached to the session of this unit of work
+        assert cache.stats()["size"] == 0
+    assert inspect(product).detached
+    assert cache.take(sku, product.version) is product
+
+    uow = ProductUnitOfWork(cache=cache)
+    with uow:
+        product = uow.get(sku=sku)
+        product.change_batch_quantity(batch_ref, 30)
+    # not committed
+    assert cache.stats()["size"] == 0
+
+
 def test_uow_retrieve_batch_and_allocate(session: Session, test_data):
     # TODO: implement tests for the unit of work
     sku, batch_ref = test_data
@@ -174,6 +225,130 @@ def test_concurrent_updates_to_version_are_not_allowed(test_data, session: Sessi
     assert version == 2
     # must have thrown an exception
     assert len(exceptions) == 1
+    assert isinstance(exceptions[0], ConcurrencyError)
+
+
+class InterleavedBatchUnitOfWork(BatchUnitOfWork):
+    """
+    Waits for the other units of work to read the batches before changing
+    them, on the first attempt only
+    """
+
+    def __init__(self, barrier: threading.Barrier) -> None:
+        super().__init__()
+        self.barrier = barrier
+
+    def __enter__(self):
+        super().__enter__()
+        list_for_sku = self.repository.list_for_sku
+
+        def list_for_sku_then_wait(*args, **kwargs):
+            batches = list_for_sku(*args, **kwargs)
+            if self.barrier is not None:
+                self.barrier.wait(timeout=5)
+                self.barrier = None
+            return batches
+
+        self.repository.list_for_sku = list_for_sku_then_wait
+
+
+def allocate_concurrently(sku: str, retry: bool) -> list:
+    barrier = threading.Barrier(2)
+    outcomes = []
+
+    def try_to_allocate_batch(orderid):
+        uow = InterleavedBatchUnitOfWork(barrier)
+        try:
+            if retry:
+                batch = uow.run(allocate, order_id=orderid, sku=sku, quantity=10)
+            else:
+                batch = allocate(orderid, sku, 10, uow=uow)
+            outcomes.append(batch)
+        except Exception as e:
+            outcomes.append(e)
+
+    threads = [
+        threading.Thread(target=try_to_allocate_batch, args=(random_order_id(name),))
+        for name in ("one", "two")
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def allocated_quantity(session: Session, sku: str) -> int:
+    [[qty]] = session.execute(
+        text(
+            """
+            SELECT COALESCE(SUM(order_lines.qty), 0)
+            FROM allocations
+            JOIN order_lines ON order_lines.orderid = allocations.orderline_id
+            JOIN batch ON batch.reference = allocations.batch_id
+            WHERE batch.sku = :sku
+            """
+        ),
+        dict(sku=sku),
+    )
+    return qty
+
+
+def test_concurrent_batch_allocations_do_not_oversell(test_data, session: Session):
+    sku, batch_ref = test_data
+
+    outcomes = allocate_concurrently(sku, retry=False)
+
+    errors = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+    assert len(errors) == 1
+    assert isinstance(errors[0], ConcurrencyError)
+    assert allocated_quantity(session, sku) == 10
+    [[version]] = session.execute(
+        text("SELECT version FROM public.product WHERE sku = :sku"), dict(sku=sku)
+    )
+    assert version == 2
+
+
+def test_concurrent_batch_allocations_are_retried(test_data, session: Session):
+    sku, batch_ref = test_data
+
+    outcomes = allocate_concurrently(sku, retry=True)
+
+    errors = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+    assert len(errors) == 1
+    # the retry sees the stock allocated by the other transaction
+    assert isinstance(errors[0], InsufficientStocksException)
+    assert allocated_quantity(session, sku) == 10
+
+
+def test_allocate_many_reports_orderids_already_in_the_database(
+    test_data, session: Session
+):
+    sku, batch_ref = test_data
+    allocated, deallocated = random_order_id(), random_order_id()
+    allocate(allocated, sku, 2, uow=BatchUnitOfWork())
+    allocate(deallocated, sku, 2, uow=BatchUnitOfWork())
+    # its order line is kept, without allocation
+    deallocate(deallocated, sku, 2, uow=BatchUnitOfWork())
+
+    results = allocate_many(
+        [
+            (allocated, sku, 2),
+            (allocated, sku, 3),
+            (deallocated, sku, 2),
+            (random_order_id(), sku, 1),
+        ],
+        uow=BatchUnitOfWork(),
+    )
+
+    assert [result.error for result in results] == [
+        None,
+        f"Duplicate orderid: {allocated}",
+        f"Duplicate orderid: {deallocated}",
+        None,
+    ]
+    assert [result.batchref for result in results] == [batch_ref, None, None, batch_ref]
+    assert allocated_quantity(session, sku) == 3
 
 
 def test_rolls_back_uncommitted_work_by_default(session: Session):
@@ -109,3 +109,20 @@ def test_deallocate_allocated_order():
     assert batch == deallocated_batch
     assert batch.available_quantity == deallocated_batch.available_quantity
     assert deallocated_batch.available_quantity == 100
+
+
+def test_allocated_quantity_is_kept_in_sync_with_allocations():
+    batch = Batch("batch-ref-1", "TABLE", 100, None)
+    line_one = Orderline("order-ref-1", "TABLE", 10)
+    line_two = Orderline("order-ref-2", "TABLE", 5)
+
+    batch.allocate(line_one)
+    batch.allocate(line_two)
+    assert batch.allocated_quantity == 15
+
+    batch.deallocate(line_one)
+    assert batch.allocated_quantity == 5
+
+    assert batch.deallocate_one() == line_two
+    assert batch.allocated_quantity == 0
+    assert batch.available_quantity == 100
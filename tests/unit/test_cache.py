@@ -0,0 +1,36 @@
+from infrastructure.cache import AggregateCache
+
+
+def test_cached_aggregate_is_only_reused_at_the_same_version():
+    cache = AggregateCache(max_size=2, ttl=60)
+    product = object()
+
+    cache.put("SMALL-FORK", product, version=1)
+
+    assert cache.take("SMALL-FORK", version=2) is None
+    cache.put("SMALL-FORK", product, version=1)
+    assert cache.take("SMALL-FORK", version=1) is product
+    # taken out while in use
+    assert cache.take("SMALL-FORK", version=1) is None
+
+    assert cache.stats() == dict(size=0, hits=1, misses=2, evictions=1)
+
+
+def test_least_recently_cached_aggregate_is_evicted():
+    cache = AggregateCache(max_size=2, ttl=60)
+
+    cache.put("SMALL-FORK", "fork", version=1)
+    cache.put("SMALL-SPOON", "spoon", version=1)
+    cache.put("SMALL-KNIFE", "knife", version=1)
+
+    assert cache.take("SMALL-FORK", version=1) is None
+    assert cache.take("SMALL-SPOON", version=1) == "spoon"
+    assert cache.take("SMALL-KNIFE", version=1) == "knife"
+
+
+def test_expired_aggregate_is_not_reused():
+    cache = AggregateCache(max_size=2, ttl=-1)
+
+    cache.put("SMALL-FORK", "fork", version=1)
+
+    assert cache.take("SMALL-FORK", version=1) is None
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+from sqlalchemy import create_engine
+
+from infrastructure.database import (
+    EngineProvider,
+    TimedQueuePool,
+    get_pool_stats,
+)
+
+
+@pytest.fixture
+def provider():
+    provider = EngineProvider(
+        lambda: create_engine(url="sqlite://", poolclass=TimedQueuePool)
+    )
+    yield provider
+    provider.reset()
+
+
+def test_engine_is_created_once_per_process(provider):
+    engine = provider.get_engine()
+
+    assert provider.get_engine() is engine
+    assert provider.get_session_factory().kw["bind"] is engine
+
+
+def test_engine_is_recreated_after_a_fork(provider):
+    engine = provider.get_engine()
+
+    # what os.fork runs in the child process
+    provider.after_fork()
+
+    assert provider.get_engine() is not engine
+
+
+def test_engine_is_recreated_when_used_from_another_process(provider, monkeypatch):
+    engine = provider.get_engine()
+
+    monkeypatch.setattr(os, "getpid", lambda: -1)
+
+    assert provider.get_engine() is not engine
+
+
+def test_pool_stats_report_checkouts(provider):
+    with provider.get_engine().connect():
+        stats = get_pool_stats(provider)
+        assert stats["checked_out"] == 1
+        assert stats["checkouts"] == 1
+
+    assert get_pool_stats(provider)["checked_out"] == 0
@@ -0,0 +1,144 @@
+import threading
+import time
+
+from domain.events import OutOfStockEvent
+from services.message_bus import (
+    Coalescer,
+    Coalescing,
+    HandlerPool,
+    batch_handler,
+    handle_events,
+)
+
+
+def test_events_with_the_same_key_are_coalesced_within_the_window():
+    now = [0.0]
+    coalescer = Coalescer(
+        policies={OutOfStockEvent: Coalescing(key=lambda e: e.sku, window=10)},
+        clock=lambda: now[0],
+    )
+    handled = []
+
+    for sku in ("SMALL-FORK", "SMALL-FORK", "SMALL-SPOON"):
+        handle_events(
+            [OutOfStockEvent(sku=sku)],
+            handlers={OutOfStockEvent: [handled.append]},
+            coalescer=coalescer,
+        )
+    now[0] = 11
+    handle_events(
+        [OutOfStockEvent(sku="SMALL-FORK")],
+        handlers={OutOfStockEvent: [handled.append]},
+        coalescer=coalescer,
+    )
+
+    assert [event.sku for event in handled] == [
+        "SMALL-FORK",
+        "SMALL-SPOON",
+        "SMALL-FORK",
+    ]
+    assert coalescer.coalesced == 1
+
+
+def test_failed_events_are_not_taken_for_duplicates():
+    coalescer = Coalescer(
+        policies={OutOfStockEvent: Coalescing(key=lambda e: e.sku, window=10)}
+    )
+
+    def failing_handler(event):
+        raise ValueError("cannot send email")
+
+    event = OutOfStockEvent(sku="SMALL-FORK")
+    failed = handle_events(
+        [event], handlers={OutOfStockEvent: [failing_handler]}, coalescer=coalescer
+    )
+
+    assert failed == [event]
+    assert coalescer.coalesce(failing_handler, [event]) == [event]
+
+
+def test_only_the_failed_handlers_get_the_events_again():
+    coalescer = Coalescer(
+        policies={OutOfStockEvent: Coalescing(key=lambda e: e.sku, window=10)}
+    )
+    batches, attempts = [], []
+
+    @batch_handler
+    def send_notifications(events):
+        batches.append([event.sku for event in events])
+
+    def flaky_handler(event):
+        attempts.append(event.sku)
+        if len(attempts) == 1:
+            raise ValueError("webhook is down")
+
+    handlers = {OutOfStockEvent: [send_notifications, flaky_handler]}
+    events = [OutOfStockEvent(sku=sku) for sku in ("SMALL-FORK", "SMALL-SPOON")]
+
+    failed = handle_events(events, handlers=handlers, coalescer=coalescer)
+    assert failed == [events[0]]
+    # the relay retries the failed event
+    assert handle_events(failed, handlers=handlers, coalescer=coalescer) == []
+
+    assert batches == [["SMALL-FORK", "SMALL-SPOON"]]
+    assert attempts == ["SMALL-FORK", "SMALL-SPOON", "SMALL-FORK"]
+
+
+def test_batch_handlers_get_the_events_of_their_type_at_once():
+    batches, handled = [], []
+
+    @batch_handler
+    def handler(events):
+        batches.append([event.sku for event in events])
+
+    handle_events(
+        [OutOfStockEvent(sku=sku) for sku in ("SMALL-FORK", "SMALL-SPOON")],
+        handlers={OutOfStockEvent: [handler, handled.append]},
+        coalescer=Coalescer(policies={}),
+    )
+
+    assert batches == [["SMALL-FORK", "SMALL-SPOON"]]
+    # the other handlers get them one by one
+    assert [event.sku for event in handled] == ["SMALL-FORK", "SMALL-SPOON"]
+
+
+def test_pool_gives_up_on_handlers_running_past_the_timeout():
+    release = threading.Event()
+    handled = []
+    pool = HandlerPool(workers=2, timeout=0.05)
+
+    def slow_handler(event):
+        release.wait()
+
+    event = OutOfStockEvent(sku="SMALL-FORK")
+    failed = handle_events(
+        [event],
+        handlers={OutOfStockEvent: [slow_handler, handled.append]},
+        coalescer=Coalescer(policies={}),
+        pool=pool,
+    )
+    release.set()
+
+    assert failed == [event]
+    assert handled == [event]
+    assert pool.stats() == dict(workers=2, processed=1, failed=0, timed_out=1)
+
+
+def test_pool_runs_at_most_workers_handlers_at_once():
+    running, most_running = [0], [0]
+    lock = threading.Lock()
+
+    def handler(event):
+        with lock:
+            running[0] += 1
+            most_running[0] = max(most_running[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+
+    pool = HandlerPool(workers=2, timeout=1)
+    failed = pool.run([(handler, OutOfStockEvent(sku=str(i))) for i in range(6)])
+
+    assert failed == []
+    assert most_running[0] == 2
+    assert pool.stats()["processed"] == 6
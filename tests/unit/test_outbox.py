@@ -0,0 +1,83 @@
+from domain.aggregates import Product
+from domain.events import OutOfStockEvent
+from domain.models import Batch, Orderline
+from infrastructure.outbox import FakeOutbox, deserialize_event, serialize_event
+from services.outbox_relay import relay_events
+from services.unit_of_work import ProductFakeUnitOfWork
+
+
+def test_events_are_serialized_by_type():
+    event = OutOfStockEvent(sku="SMALL-FORK")
+
+    assert deserialize_event(*serialize_event(event)) == event
+
+
+def test_unit_of_work_adds_events_to_outbox_on_commit():
+    product = Product(sku="SMALL-FORK", batches=[Batch("batch1", "SMALL-FORK", 1)])
+    uow = ProductFakeUnitOfWork([product])
+
+    with uow:
+        uow.repository.get("SMALL-FORK").allocate(Orderline("order1", "SMALL-FORK", 2))
+        assert uow.outbox.events == {}
+        uow.commit()
+
+    assert list(uow.outbox.events.values()) == [OutOfStockEvent(sku="SMALL-FORK")]
+    assert product.events == []
+
+
+def test_relay_removes_handled_events():
+    outbox = FakeOutbox()
+    for sku in ("SMALL-FORK", "SMALL-SPOON", "SMALL-KNIFE"):
+        outbox.add(OutOfStockEvent(sku=sku))
+    handled = []
+
+    def handle(events):
+        handled.extend(events)
+        return []
+
+    assert relay_events(outbox, handle, batch_size=2) == 2
+    assert [event.sku for event in handled] == ["SMALL-FORK", "SMALL-SPOON"]
+    assert list(outbox.events.values()) == [OutOfStockEvent(sku="SMALL-KNIFE")]
+
+
+def test_relay_retries_failed_events_up_to_max_attempts():
+    outbox = FakeOutbox()
+    outbox.add(OutOfStockEvent(sku="SMALL-FORK"))
+    outbox.add(OutOfStockEvent(sku="SMALL-SPOON"))
+    handled = []
+
+    def handle(events):
+        handled.extend(event for event in events if event.sku != "SMALL-FORK")
+        return [event for event in events if event.sku == "SMALL-FORK"]
+
+    for _ in range(3):
+        relay_events(outbox, handle, max_attempts=2)
+
+    assert handled == [OutOfStockEvent(sku="SMALL-SPOON")]
+    assert outbox.attempts == {1: 2}
+    assert outbox.claim(limit=10, max_attempts=2) == []
+
+
+def test_relay_retries_the_whole_batch_when_handle_raises():
+    outbox = FakeOutbox()
+    outbox.add(OutOfStockEvent(sku="SMALL-FORK"))
+    outbox.add(OutOfStockEvent(sku="SMALL-SPOON"))
+
+    def handle(events):
+        raise ValueError("cannot send email")
+
+    assert relay_events(outbox, handle) == 2
+    assert outbox.attempts == {1: 1, 2: 1}
+
+
+def test_outbox_stats_report_pending_and_given_up_events():
+    outbox = FakeOutbox()
+    outbox.add(OutOfStockEvent(sku="SMALL-FORK"))
+    outbox.add(OutOfStockEvent(sku="SMALL-SPOON"))
+    outbox.mark_failed([1])
+
+    stats = outbox.stats(max_attempts=1)
+
+    assert (stats["pending"], stats["given_up"]) == (1, 1)
+    assert stats["lag"] >= 0
+    assert FakeOutbox().stats(max_attempts=1) == dict(pending=0, given_up=0, lag=0)
@@ -7,7 +7,6 @@ from domain.events import OutOfStockEvent
 from domain.models import Batch, DeallocateStocksException, Orderline
 
 
-@pytest.mark.skip
 def test_records_out_of_stock_event_if_cannot_allocate():
     batch = Batch("batch1", "SMALL-FORK", 10, eta=datetime.date.today())
     product = Product(sku="SMALL-FORK", batches=[batch])
@@ -60,3 +59,69 @@ def test_raise_deallocation_exception_if_orderline_not_allocated():
 
     with pytest.raises(DeallocateStocksException):
         product.deallocate(orderline)
+
+
+def test_allocate_prefers_in_stock_then_earliest_eta_batches():
+    today = datetime.date.today()
+    later_batch = Batch("later", "SMALL-FORK", 10, eta=today + datetime.timedelta(2))
+    earlier_batch = Batch("earlier", "SMALL-FORK", 10, eta=today)
+    product = Product(sku="SMALL-FORK", batches=[later_batch, earlier_batch])
+
+    assert product.allocate(Orderline("order_id_1", "SMALL-FORK", 10)) == "earlier"
+
+    in_stock_batch = Batch("in-stock", "SMALL-FORK", 10, eta=None)
+    product.add_batch(in_stock_batch)
+
+    assert product.batches_by_eta == [in_stock_batch, earlier_batch, later_batch]
+    assert product.allocate(Orderline("order_id_2", "SMALL-FORK", 5)) == "in-stock"
+
+
+def test_allocated_batch_is_tracked_through_allocate_and_deallocate():
+    orderline = Orderline("order_id_1", "SMALL-FORK", 10)
+    batch_1 = Batch("batch_id_1", "SMALL-FORK", 15, eta=None)
+    batch_2 = Batch("batch_id_2", "SMALL-FORK", 50, eta=datetime.date.today())
+    product = Product(sku="SMALL-FORK", batches=[batch_1, batch_2])
+
+    assert product.allocated_batch("order_id_1") is None
+
+    product.allocate(orderline)
+    assert product.allocated_batch("order_id_1") == batch_1
+
+    product.deallocate(orderline)
+    assert product.allocated_batch("order_id_1") is None
+
+
+def test_change_batch_quantity_deallocates_lines_out_of_the_index():
+    first_line = Orderline("order_id_1", "SMALL-FORK", 10)
+    second_line = Orderline("order_id_2", "SMALL-FORK", 5)
+    batch = Batch("batch_id_1", "SMALL-FORK", 15, eta=None)
+    batch.allocate(first_line)
+    batch.allocate(second_line)
+    # as loaded from the database, the index is yet to be built
+    product = Product(sku="SMALL-FORK", batches=[batch])
+
+    [deallocated] = product.change_batch_quantity("batch_id_1", 10)
+
+    [kept] = {first_line, second_line} - {deallocated}
+    assert product.allocated_batch(deallocated.orderid) is None
+    assert product.allocated_batch(kept.orderid) == batch
+    assert batch.available_quantity == 10 - kept.qty
+    with pytest.raises(DeallocateStocksException):
+        product.deallocate(deallocated)
+
+
+def test_lines_of_the_same_order_are_deallocated_separately():
+    first_line = Orderline("order_id_1", "SMALL-FORK", 10)
+    second_line = Orderline("order_id_1", "SMALL-FORK", 5)
+    batch_1 = Batch("batch_id_1", "SMALL-FORK", 10, eta=None)
+    batch_2 = Batch("batch_id_2", "SMALL-FORK", 50, eta=datetime.date.today())
+    product = Product(sku="SMALL-FORK", batches=[batch_1, batch_2])
+
+    assert product.allocate(first_line) == "batch_id_1"
+    assert product.allocate(second_line) == "batch_id_2"
+
+    assert product.deallocate(first_line) == "batch_id_1"
+    assert product.allocated_batch("order_id_1") == batch_2
+    assert product.deallocate(second_line) == "batch_id_2"
+    assert product.allocated_batch("order_id_1") is None
+    assert product.available_quantity == 60
@@ -0,0 +1,72 @@
+import json
+from datetime import date
+
+import pytest
+
+from domain.aggregates import Product
+from domain.models import Batch, Orderline
+from infrastructure.serialization import dumps, product_schema
+
+
+def make_product() -> Product:
+    batch = Batch("batch1", "SMALL-FORK", 10, eta=date(2026, 1, 31))
+    batch.allocate(Orderline("order1", "SMALL-FORK", 2))
+    return Product(sku="SMALL-FORK", batches=[batch], version=3)
+
+
+def test_product_schema_dumps_nested_batches_and_lines():
+    assert product_schema.dump(make_product()) == {
+        "sku": "SMALL-FORK",
+        "batches": [
+            {
+                "sku": "SMALL-FORK",
+                "reference": "batch1",
+                "_purchased_quantity": 10,
+                "eta": date(2026, 1, 31),
+                "_allocations": [{"orderid": "order1", "sku": "SMALL-FORK", "qty": 2}],
+            }
+        ],
+        "version": 3,
+    }
+
+
+def test_dumps_encodes_aggregates_and_dates_to_bytes():
+    encoded = dumps({"products": [make_product()]})
+
+    assert isinstance(encoded, bytes)
+    assert json.loads(encoded) == {
+        "products": [json.loads(dumps(product_schema.dump(make_product())))]
+    }
+    assert json.loads(encoded)["products"][0]["batches"][0]["eta"] == "2026-01-31"
+
+
+def test_schema_excludes_nested_fields():
+    schema = product_schema.exclude(["version", "batches._allocations"])
+
+    assert schema.dump(make_product()) == {
+        "sku": "SMALL-FORK",
+        "batches": [
+            {
+                "sku": "SMALL-FORK",
+                "reference": "batch1",
+                "_purchased_quantity": 10,
+                "eta": date(2026, 1, 31),
+            }
+        ],
+    }
+
+
+def test_schema_rejects_unknown_fields():
+    with pytest.raises(KeyError):
+        product_schema.exclude(["batches.colour"])
+
+
+def test_iterencode_streams_a_json_array():
+    schema = product_schema.exclude(["batches"])
+    products = [Product(sku=sku, batches=[]) for sku in ("SMALL-FORK", "SMALL-SPOON")]
+
+    assert json.loads(b"".join(schema.iterencode(products))) == [
+        {"sku": "SMALL-FORK", "version": 0},
+        {"sku": "SMALL-SPOON", "version": 0},
+    ]
+    assert b"".join(schema.iterencode([])) == b"[]"
@@ -4,6 +4,8 @@ from typing import List, Type
 import pytest
 from sqlalchemy.orm import Session
 
+from domain.aggregates import Product
+from domain.events import OutOfStockEvent
 from domain.models import Batch, InsufficientStocksException, Orderline
 from infrastructure.repository import (
     BatchFakeRepository,
@@ -12,8 +14,15 @@ from infrastructure.repository import (
 )
 
 # from services import FakeUnitOfWork
-from services.services import InvalidSkuError, allocate, deallocate
-from services.unit_of_work import BatchFakeUnitOfWork
+from services.services import (
+    InvalidSkuError,
+    allocate,
+    allocate_many,
+    deallocate,
+    restock,
+)
+from services.unit_of_work import BatchFakeUnitOfWork, ConcurrencyError
+from services.views import allocation, availability
 
 # tests about orchestration stuff
 
@@ -182,6 +191,24 @@ def test_allocate_order_next_available_batch():
         )
 
 
+def test_allocate_prefers_in_stock_then_earliest_batches():
+    later_batch = Batch(
+        "later-batch", "RETRO-CLOCK", 10, eta=(date.today() + timedelta(days=2))
+    )
+    in_stock_batch = Batch("in-stock-batch", "RETRO-CLOCK", 10)
+    shipping_batch = Batch(
+        "shipping-batch", "RETRO-CLOCK", 10, eta=(date.today() + timedelta(days=1))
+    )
+    uow = BatchFakeUnitOfWork([later_batch, in_stock_batch, shipping_batch])
+
+    batches = [
+        allocate(order_id=orderid, sku="RETRO-CLOCK", quantity=10, uow=uow)
+        for orderid in ("order-1-ref", "order-2-ref", "order-3-ref")
+    ]
+
+    assert batches == [in_stock_batch, shipping_batch, later_batch]
+
+
 def test_allocate_idemptotent_allocation():
     batch_1 = Batch("batch-1-ref", "RETRO-CLOCK", 10)
     batch_2 = Batch("batch-2-ref", "RETRO-CLOCK", 20)
@@ -235,3 +262,201 @@ def test_deallocate_order_from_batches():
     )
 
     assert shipping_batch.contains(first_order_clock) == False
+
+
+def test_allocate_only_considers_batches_of_the_line_sku():
+    other_sku_batch = Batch("other-batch", "RETRO-LAMP", 100)
+    clock_batch = Batch("clock-batch", "RETRO-CLOCK", 100)
+
+    uow = BatchFakeUnitOfWork([other_sku_batch, clock_batch])
+
+    assert uow.repository.list_for_sku("RETRO-CLOCK") == [clock_batch]
+
+    batch = allocate("order-ref", "RETRO-CLOCK", 10, uow)
+
+    assert batch == clock_batch
+    assert other_sku_batch.available_quantity == 100
+
+
+def test_allocate_many_returns_a_result_per_line():
+    clock_batch = Batch("clock-batch", "RETRO-CLOCK", 15)
+    lamp_batch = Batch("lamp-batch", "RETRO-LAMP", 10)
+
+    uow = BatchFakeUnitOfWork([clock_batch, lamp_batch])
+
+    results = allocate_many(
+        [
+            ("order-1", "RETRO-CLOCK", 10),
+            ("order-2", "RETRO-LAMP", 10),
+            ("order-3", "RETRO-CLOCK", 10),
+            ("order-4", "RETRO-CHAIR", 1),
+        ],
+        uow,
+    )
+
+    assert [result.orderid for result in results] == [
+        "order-1",
+        "order-2",
+        "order-3",
+        "order-4",
+    ]
+    assert results[0].batchref == "clock-batch"
+    assert results[1].batchref == "lamp-batch"
+    assert results[2].batchref is None
+    assert results[2].error == "Insufficient in stock for RETRO-CLOCK"
+    assert results[3].error == "Invalid sku: RETRO-CHAIR"
+    assert clock_batch.available_quantity == 5
+    assert uow.comitted
+
+
+def test_allocate_many_reports_invalid_and_duplicate_lines():
+    clock_batch = Batch("clock-batch", "RETRO-CLOCK", 15)
+    uow = BatchFakeUnitOfWork([clock_batch])
+
+    results = allocate_many(
+        [
+            ("order-1", "RETRO-CLOCK", 5),
+            ("order-1", "RETRO-CLOCK", 3),
+            ("order-2", "RETRO-CLOCK", "3"),
+            ("order-3", "RETRO-CLOCK", -1),
+            ("order-4", ["RETRO-CLOCK"], 1),
+            ("order-5", "RETRO-CLOCK", 2),
+        ],
+        uow,
+    )
+
+    assert [result.batchref for result in results] == [
+        "clock-batch",
+        None,
+        None,
+        None,
+        None,
+        "clock-batch",
+    ]
+    assert results[1].error == "Duplicate orderid: order-1"
+    assert results[2].error == "Invalid quantity: '3'"
+    assert results[3].error == "Invalid quantity: -1"
+    assert results[4].error == "orderid and sku must be strings"
+    assert clock_batch.available_quantity == 8
+    assert uow.comitted
+
+
+def test_allocate_many_reports_orderids_of_existing_order_lines():
+    clock_batch = Batch("clock-batch", "RETRO-CLOCK", 15)
+    lamp_batch = Batch("lamp-batch", "RETRO-LAMP", 15)
+    lamp_batch.allocate(Orderline("order-1", "RETRO-LAMP", 5))
+    uow = BatchFakeUnitOfWork([clock_batch, lamp_batch])
+
+    results = allocate_many(
+        [("order-1", "RETRO-CLOCK", 5), ("order-2", "RETRO-CLOCK", 5)], uow
+    )
+
+    assert [result.error for result in results] == [
+        "Duplicate orderid: order-1",
+        None,
+    ]
+    assert clock_batch.available_quantity == 10
+
+
+def test_out_of_stock_allocations_record_an_event():
+    uow = BatchFakeUnitOfWork([Batch("clock-batch", "RETRO-CLOCK", 10)])
+
+    with pytest.raises(InsufficientStocksException):
+        allocate("order-1", "RETRO-CLOCK", 20, uow)
+
+    assert list(uow.outbox.events.values()) == [OutOfStockEvent(sku="RETRO-CLOCK")]
+    assert uow.comitted
+
+    allocate_many(
+        [
+            ("order-2", "RETRO-CLOCK", 5),
+            ("order-3", "RETRO-CLOCK", 20),
+            ("order-4", "RETRO-CLOCK", 30),
+        ],
+        uow,
+    )
+
+    # once per sku out of stock
+    assert list(uow.outbox.events.values()) == [
+        OutOfStockEvent(sku="RETRO-CLOCK"),
+        OutOfStockEvent(sku="RETRO-CLOCK"),
+    ]
+
+
+def test_read_model_follows_allocations():
+    uow = BatchFakeUnitOfWork([])
+    restock("clock-batch", "RETRO-CLOCK", 20, None, uow)
+
+    assert availability("RETRO-CLOCK", uow) == 20
+
+    allocate("order-1", "RETRO-CLOCK", 5, uow)
+    # allocating the same line again is a no-op
+    allocate("order-1", "RETRO-CLOCK", 5, uow)
+
+    assert availability("RETRO-CLOCK", uow) == 15
+    assert allocation("order-1", uow) == dict(
+        orderid="order-1", sku="RETRO-CLOCK", qty=5, batchref="clock-batch"
+    )
+
+    deallocate("order-1", "RETRO-CLOCK", 5, uow)
+
+    assert availability("RETRO-CLOCK", uow) == 20
+    assert allocation("order-1", uow) is None
+    assert availability("RETRO-LAMP", uow) is None
+
+
+def test_fake_repository_pages_products_by_sku():
+    repository = ProductFakeRepository(
+        [Product(sku=sku, batches=[]) for sku in ("C-SKU", "A-SKU", "B-SKU")]
+    )
+
+    assert [p.sku for p in repository.list_page(limit=2)] == ["A-SKU", "B-SKU"]
+    assert [p.sku for p in repository.list_page(after="B-SKU")] == ["C-SKU"]
+    assert [p.sku for p in repository.stream(after="A-SKU")] == ["B-SKU", "C-SKU"]
+
+
+def test_batch_writes_bump_the_product_version():
+    uow = BatchFakeUnitOfWork([Batch("batch-ref-1", "MY-CHAIR", 100)])
+
+    allocate(order_id="order1", sku="MY-CHAIR", quantity=10, uow=uow)
+    deallocate(orderid="order1", sku="MY-CHAIR", qty=10, uow=uow)
+    allocate_many([("order2", "MY-CHAIR", 10), ("order3", "MY-CHAIR", 5)], uow=uow)
+
+    assert uow.repository.product_versions == {"MY-CHAIR": 3}
+
+
+def test_allocating_an_allocated_line_again_keeps_the_product_version():
+    uow = BatchFakeUnitOfWork([Batch("batch-ref-1", "MY-CHAIR", 100)])
+    allocate(order_id="order1", sku="MY-CHAIR", quantity=10, uow=uow)
+
+    allocate(order_id="order1", sku="MY-CHAIR", quantity=10, uow=uow)
+    allocate_many([("order1", "MY-CHAIR", 10)], uow=uow)
+
+    assert uow.repository.product_versions == {"MY-CHAIR": 1}
+
+
+def test_batch_writes_fail_if_the_product_changed_since_it_was_read():
+    uow = BatchFakeUnitOfWork([Batch("batch-ref-1", "MY-CHAIR", 10)])
+    list_for_sku = uow.repository.list_for_sku
+
+    def list_for_sku_then_concurrent_write(sku, *args, **kwargs):
+        batches = list_for_sku(sku, *args, **kwargs)
+        version = uow.repository.get_product_version(sku)
+        uow.repository.bump_product_version(sku, version)
+        return batches
+
+    uow.repository.list_for_sku = list_for_sku_then_concurrent_write
+
+    with pytest.raises(ConcurrencyError):
+        allocate(order_id="order1", sku="MY-CHAIR", quantity=10, uow=uow)
+    assert not getattr(uow, "comitted", False)
+
+
+def test_version_digest_changes_with_the_product_versions():
+    product = Product(sku="A-SKU", batches=[])
+    repository = ProductFakeRepository([product, Product(sku="B-SKU", batches=[])])
+    digest = repository.version_digest()
+
+    assert repository.version_digest(limit=1) != digest
+    product.version += 1
+    assert repository.version_digest() != digest
@@ -0,0 +1,83 @@
+import pytest
+from sqlalchemy.orm import Session
+
+from infrastructure.cache import product_cache
+from services.unit_of_work import (
+    ConcurrencyError,
+    ProductUnitOfWork,
+    ReadOnlyProductUnitOfWork,
+    ReadOnlyUnitOfWorkError,
+    RetryPolicy,
+    retry_stats,
+)
+from settings import global_settings
+
+
+def make_uow(attempts: int) -> ProductUnitOfWork:
+    return ProductUnitOfWork(
+        session_factory=Session,
+        retry_policy=RetryPolicy(attempts=attempts, backoff=0, max_backoff=0),
+    )
+
+
+def test_run_retries_service_on_concurrency_error():
+    calls = []
+
+    def service(sku: str, uow: ProductUnitOfWork):
+        calls.append(sku)
+        with uow:
+            if len(calls) < 3:
+                raise ConcurrencyError("conflict")
+            return sku
+
+    retries = retry_stats.retries
+
+    assert make_uow(attempts=3).run(service, sku="SMALL-FORK") == "SMALL-FORK"
+    assert len(calls) == 3
+    assert retry_stats.retries == retries + 2
+
+
+def test_run_gives_up_after_the_configured_attempts():
+    calls = []
+
+    def service(uow: ProductUnitOfWork):
+        calls.append(uow)
+        raise ConcurrencyError("conflict")
+
+    failures = retry_stats.failures
+
+    with pytest.raises(ConcurrencyError):
+        make_uow(attempts=2).run(service)
+
+    assert len(calls) == 2
+    assert retry_stats.failures == failures + 1
+
+
+def test_run_does_not_retry_other_errors():
+    calls = []
+
+    def service(uow: ProductUnitOfWork):
+        calls.append(uow)
+        raise ValueError("not a concurrency problem")
+
+    with pytest.raises(ValueError):
+        make_uow(attempts=3).run(service)
+
+    assert len(calls) == 1
+
+
+def test_read_only_unit_of_work_never_commits():
+    uow = ReadOnlyProductUnitOfWork(session_factory=Session)
+
+    with pytest.raises(ReadOnlyUnitOfWorkError):
+        with uow:
+            uow.commit()
+
+
+def test_product_cache_is_used_by_write_paths_when_enabled(monkeypatch):
+    assert ProductUnitOfWork().cache is None
+
+    monkeypatch.setattr(global_settings, "PRODUCT_CACHE_ENABLED", True)
+
+    assert ProductUnitOfWork().cache is product_cache
+    assert ReadOnlyProductUnitOfWork().cache is None